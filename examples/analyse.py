@@ -42,7 +42,8 @@ data1.read_tiff(out_folder+'data-roi/')
 spang1 = spang.Spang(f=np.zeros(data1.g.shape[0:3] + (15,)),
                      vox_dim=vox_dim_data)
 micro1 = multi.MultiMicroscope(spang1, data1, n_samp=1.33, lamb=525,
-                               spang_coupling=True)
+                               spang_coupling=True,
+                               cache_dir=out_folder + 'H-cache/')
 
 # Calculate expected values from fluorescent lake
 lake_response = micro1.lake_response(data1)
@@ -58,9 +59,8 @@ data1.apply_voxel_size_correction(vox_dim_A, vox_dim_B)
 # data1.save_mips(out_folder + 'data-corrected.pdf', normalize=True)
 # data1.save_tiff(out_folder+'data-corrected/', diSPIM_format=True)
 
-# Calculate system matrix
-# micro1.calc_H(); micro1.save_H(out_folder + 'H.npz')
-micro1.load_H(out_folder + 'H.npz')
+# Calculate system matrix (loaded from the cache after the first run)
+micro1.calc_H()
 
 # Calculate pseudoinverse solution
 # set "eta" to a list of positive number for Tikhonov regularization
@@ -56,18 +56,18 @@ if __name__ == '__main__':
     data1.save_tiff(out_folder+'data-corrected/', diSPIM_format=True) 
 
     # Calculate system matrix
+    # try "cache_dir=out_folder+'H-cache/'" in MultiMicroscope to reuse H
     m.calc_H()
-    # m.save_H(folder + 'H.npz') # try saving and loading H to save time
-    # m.load_H(folder + 'H.npz')
 
     # Calculate pseudoinverse solution
     # set "etas" to a list of positive number for Tikhonov regularization
+    # pinv_sweep factors H once and reuses it for every eta
     etas = [3e0]
-    for eta in etas:
+    for eta, f in m.pinv_sweep(data1.g, etas):
         eta_string = '{:.1e}'.format(eta)
         print("Reconstructing with eta = " + eta_string)
 
-        spang1.f = m.pinv(data1.g, eta=eta)
+        spang1.f = f
         spang1.save_tiff(out_folder+'guv-recon/'+'sh.tif')
         spang1.visualize(out_folder+'flyaround/', mask=spang1.density()>0.35,
                          video=True, n_frames=18, scale=4, roi_scale=1.0,
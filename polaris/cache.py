@@ -0,0 +1,82 @@
+import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+import logging
+log = logging.getLogger('log')
+
+# Bump when the layout of cached arrays changes
+VERSION = 1
+
+def _jsonable(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError('Cannot hash ' + repr(x))
+
+def key(params):
+    # Content hash of a dictionary of parameters (numbers, strings, lists,
+    # tuples and numpy arrays)
+    params = dict(params, cache_version=VERSION)
+    text = json.dumps(params, sort_keys=True, default=_jsonable)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class Cache:
+    """A Cache is a folder of .npz files named by the hash of the parameters
+    that produced them. 
+
+    Entries are written atomically, so an interrupted save never leaves a
+    partial file behind. If max_bytes is set, the least recently used 
+    entries are removed until the folder fits.
+    """
+    def __init__(self, folder, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        log.info('Loading cached '+path)
+        os.utime(path) # Mark as recently used
+        with np.load(path) as files:
+            return {k: files[k] for k in files.files}
+
+    def save(self, key, **arrays):
+        path = self.path(key)
+        log.info('Caching '+path)
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                path = os.path.join(self.folder, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            log.info('Evicting cached '+path)
+            os.remove(path)
+            total -= size
@@ -24,16 +24,19 @@ class Data:
         self.X = g.shape[0]
         self.Y = g.shape[1]
         self.Z = g.shape[2]
-        self.P = pols.shape[1]
         self.V = pols.shape[0]
         self.vox_dim = vox_dim
-        self.pols = pols
-        self.pols_norm = pols/np.linalg.norm(pols, axis=2)[:,:,None] # V X P X 3
+        self.set_pols(pols)
         self.ill_nas = ill_nas
         self.det_nas = det_nas
         self.ill_optical_axes = ill_optical_axes
         self.det_optical_axes = det_optical_axes
 
+    def set_pols(self, pols):
+        self.pols = pols
+        self.pols_norm = pols/np.linalg.norm(pols, axis=2)[:,:,None] # V X P X 3
+        self.P = pols.shape[1]
+
     def remove_background(self, percentile=None):
         log.info('Applying background correction')
         # By default subtract the average of a 10x10x10 ROI with corner at
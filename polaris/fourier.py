@@ -0,0 +1,178 @@
+# The FFT layer used throughout polaris.
+#
+# Backends are 'numpy', 'scipy' (scipy.fft's pocketfft with a pool of
+# workers) and 'pyfftw' (FFTW plans built once per thread, shape, dtype and
+# axes and then reused). Pick one at runtime with set_backend. With
+# single=True, real inputs are transformed as float32 and spectra stay
+# complex64.
+#
+# Every transform takes an optional out array. scipy, numpy >= 2 and pyfftw
+# write the result straight into out; an out array whose dtype does not match
+# the precision of the transform (or, for pyfftw, that is not aligned and
+# contiguous like the plan's own output) gets a copy instead.
+#
+# workers is the number of threads of one transform. Calls made from inside a
+# thread pool should pass workers=1.
+import numpy as np
+import os
+import threading
+import logging
+log = logging.getLogger('log')
+
+BACKENDS = ['numpy', 'scipy', 'pyfftw']
+
+_state = {'backend': 'scipy', 'workers': -1, 'single': False,
+          'planner_effort': 'FFTW_MEASURE'}
+
+# FFTW objects read and write their own internal arrays, so every thread
+# keeps its own plans
+_plans = {}
+_plans_lock = threading.Lock()
+
+# Normalization codes of pocketfft: none for forward, 1/n for inverse
+_inorm = {True: 0, False: 2}
+
+def set_backend(backend='scipy', workers=-1, single=False, planner_effort='FFTW_MEASURE'):
+    if backend not in BACKENDS:
+        raise ValueError('Unknown FFT backend ' + repr(backend) + ', choose from ' + str(BACKENDS))
+    if backend == 'pyfftw':
+        import pyfftw # Fail here rather than at the first transform
+    _state.update(backend=backend, workers=workers, single=single,
+                  planner_effort=planner_effort)
+    with _plans_lock:
+        _plans.clear()
+    log.info('FFT backend: ' + backend)
+
+def get_backend():
+    return _state['backend']
+
+def threads(workers=None):
+    if workers is None:
+        workers = _state['workers']
+    return os.cpu_count() if workers is None or workers < 0 else workers
+
+def spectrum_dtype(dtype):
+    # dtype of the spectrum rfftn returns for real input of dtype
+    if _state['single'] or np.dtype(dtype) == np.float32:
+        return np.dtype(np.complex64)
+    return np.dtype(np.complex128)
+
+def _cast(a, real):
+    if _state['single']:
+        return np.asarray(a, dtype=np.float32 if real else np.complex64)
+    return a
+
+def _plan(name, a, axes, s, workers):
+    # This thread's FFTW plan for the transform, built on first use
+    import pyfftw.builders
+    key = (threading.get_ident(), name, a.shape, a.dtype.str, tuple(axes),
+           None if s is None else tuple(s), workers)
+    plan = _plans.get(key)
+    if plan is None:
+        log.info('Planning FFTW ' + name + str(a.shape))
+        plan = getattr(pyfftw.builders, name)(
+            a, s=s, axes=axes, threads=workers,
+            planner_effort=_state['planner_effort'])
+        with _plans_lock:
+            _plans[key] = plan
+    return plan
+
+def _pyfftw(name, a, axes, s, out, workers):
+    import pyfftw
+    plan = _plan(name, a, axes, s, workers)
+    if out is not None:
+        try:
+            return plan(a, out)
+        except ValueError: # Misaligned or strided out
+            pass
+    # Always hand the plan an output array, never reuse its internal one
+    res = pyfftw.empty_aligned(plan.output_shape, dtype=plan.output_dtype,
+                               n=pyfftw.simd_alignment)
+    plan(a, res)
+    if out is None:
+        return res
+    out[...] = res
+    return out
+
+def _pypocketfft():
+    # scipy.fft's own kernels, which can write into out. They are private, so
+    # without them transforms go through the public scipy.fft and a copy.
+    try:
+        from scipy.fft._pocketfft import pypocketfft
+    except ImportError:
+        return None
+    return pypocketfft
+
+def _out_dtype(name, dtype):
+    c = np.result_type(dtype, np.complex64)
+    return np.empty(0, dtype=c).real.dtype if name == 'irfftn' else c
+
+def _pocketfft_fits(name, a, axes, s, out):
+    # Whether pocketfft can write the transform of a straight into out
+    types = (np.float32, np.float64) if name == 'rfftn' else (np.complex64, np.complex128)
+    if a.dtype not in types or out.dtype != _out_dtype(name, a.dtype):
+        return False
+    if name == 'irfftn': # c2r only resizes the last axis
+        return all(a.shape[ax % a.ndim] == n for ax, n in zip(axes[:-1], s[:-1]))
+    return True
+
+def _pocketfft(pfft, name, a, axes, s, out, workers):
+    axes = [ax % a.ndim for ax in axes]
+    if name == 'rfftn':
+        return pfft.r2c(a, axes, True, 0, out, workers)
+    if name == 'irfftn':
+        return pfft.c2r(a, axes, s[-1], False, 2, out, workers)
+    forward = name == 'fftn'
+    return pfft.c2c(a, axes, forward, _inorm[forward], out, workers)
+
+def _numpy_out():
+    import inspect
+    return 'out' in inspect.signature(np.fft.rfftn).parameters
+
+def _transform(name, a, axes, s, out, real, workers):
+    a = _cast(a, real)
+    backend = _state['backend']
+    workers = threads(workers)
+    if backend == 'pyfftw':
+        return _pyfftw(name, a, axes, s, out, workers)
+    if out is not None and backend == 'scipy':
+        pfft = _pypocketfft()
+        if pfft is not None and _pocketfft_fits(name, a, axes, s, out):
+            return _pocketfft(pfft, name, a, axes, s, out, workers)
+    if out is not None and backend == 'numpy' and _numpy_out():
+        try:
+            return getattr(np.fft, name)(a, s=s, axes=axes, out=out)
+        except (TypeError, ValueError): # Precision of out differs
+            pass
+    if backend == 'scipy':
+        import scipy.fft
+        A = getattr(scipy.fft, name)(a, s=s, axes=axes, workers=workers)
+    else:
+        A = getattr(np.fft, name)(a, s=s, axes=axes)
+        if _state['single']:
+            A = A.astype(np.float32 if name == 'irfftn' else np.complex64)
+    if out is None:
+        return A
+    out[...] = A
+    return out
+
+def rfftn(a, axes=(0, 1, 2), out=None, workers=None):
+    return _transform('rfftn', a, axes, None, out, True, workers)
+
+def irfftn(A, s, axes=(0, 1, 2), out=None, workers=None):
+    return _transform('irfftn', A, axes, s, out, False, workers)
+
+def fftn(a, axes=(0, 1, 2), out=None, workers=None):
+    return _transform('fftn', a, axes, None, out, False, workers)
+
+def ifftn(A, axes=(0, 1, 2), out=None, workers=None):
+    return _transform('ifftn', A, axes, None, out, False, workers)
+
+def save_wisdom(filename):
+    # Keep FFTW plans across sessions
+    import pyfftw
+    np.save(filename, np.array(pyfftw.export_wisdom(), dtype=object), allow_pickle=True)
+
+def load_wisdom(filename):
+    import pyfftw
+    pyfftw.import_wisdom(tuple(np.load(filename, allow_pickle=True)))
@@ -110,3 +110,70 @@ def multiply_sh_coefficients(a, b, evaluate=True):
                 if ai != 0 and bi != 0:
                     c[k] += ai*bi*Rgaunt(l1, l2, l3, m1, m2, m3, evaluate=evaluate)
     return c
+
+class SparseGaunt:
+    """A SparseGaunt object multiplies stacks of SH coefficients through the
+    nonzero entries of a Gaunt tensor G[j, l, s], stored as COO triples
+    (j, l, s, v).
+
+    G is symmetric in l and s, so a product only needs the pair products
+    b_l a_s + b_s a_l over the l <= s pairs with a nonzero coefficient,
+    followed by one small dense multiply with their weights W. No J x J matrix
+    is built per voxel.
+    """
+    def __init__(self, G, tol=1e-12):
+        self.shape = G.shape
+        self.j, self.l, self.s = np.nonzero(np.abs(G) > tol)
+        self.v = G[self.j, self.l, self.s]
+
+        lo, hi = np.minimum(self.l, self.s), np.maximum(self.l, self.s)
+        pairs, pair = np.unique(lo*G.shape[2] + hi, return_inverse=True)
+        self.pl, self.ps = np.divmod(pairs, G.shape[2])
+        self.W = np.zeros((len(pairs), G.shape[0]))
+        np.add.at(self.W, (pair, self.j), self.v/2)
+
+        self.D = np.zeros((G.shape[2], G.shape[0]*G.shape[1]))
+        self.D[self.s, self.j*G.shape[1] + self.l] = self.v
+
+    def multiply(self, a, b, out=None):
+        # out[..., j] = sum_ls G[j, l, s] b[..., l] a[..., s]
+        P = np.take(b, self.pl, axis=-1)
+        P *= np.take(a, self.ps, axis=-1)
+        Q = np.take(b, self.ps, axis=-1)
+        Q *= np.take(a, self.pl, axis=-1)
+        P += Q
+        if out is None:
+            return P @ self.W.astype(P.dtype)
+        out[...] = P @ self.W.astype(P.dtype)
+        return out
+
+    def matrix(self, a):
+        # M[..., j, l] = sum_s G[j, l, s] a[..., s], for division, as one
+        # multiply with the triples scattered into an S x (J*L) table
+        M = a @ self.D.astype(a.dtype)
+        return M.reshape(a.shape[:-1] + self.shape[0:2])
+
+    def divide(self, a, b, mask=None, out=None, block=512):
+        # Coefficients x of a/b, the solution of matrix(b) x = a, on the voxels
+        # in mask and zero elsewhere. Voxels are solved block voxels at a time
+        # to stay in cache. Singular blocks and voxels with non-finite
+        # solutions fall back to the pseudoinverse.
+        if out is None:
+            out = np.zeros(a.shape, dtype=np.result_type(a, b))
+        if mask is None:
+            mask = np.ones(a.shape[:-1], dtype=bool)
+        A, B = a[mask], b[mask]
+        X = np.zeros(A.shape, dtype=out.dtype)
+        for i in range(0, len(A), block):
+            M = self.matrix(B[i:i + block])
+            try:
+                x = np.linalg.solve(M, A[i:i + block, :, None])[..., 0]
+            except np.linalg.LinAlgError:
+                x = np.full(M.shape[:-1], np.nan)
+            bad = ~np.all(np.isfinite(x), axis=-1)
+            if np.any(bad):
+                x[bad] = np.einsum('njl,nl->nj', np.linalg.pinv(M[bad]), A[i:i + block][bad])
+            X[i:i + block] = x
+        out[...] = 0
+        out[mask] = X
+        return out
@@ -10,6 +10,15 @@ import itertools
 # Compute gaunt coefficients
 # gaunt.calc_gaunt_tensor('gaunt_l4.npy', lmax=4) # Expensive precomputation
 G = np.load(os.path.join(os.path.dirname(__file__), 'gaunt_l4.npy')) 
+GS = gaunt.SparseGaunt(G)
+
+# Rotation by 90 degrees about the y axis for the l <= 2 coefficients (diSPIM)
+R = np.array([[1,0,0,0,0,0],
+              [0,0,1,0,0,0], # Careful with -1 here
+              [0,1,0,0,0,0],
+              [0,0,0,-1/2,0,np.sqrt(3)/2],
+              [0,0,0,0,1,0],
+              [0,0,0,np.sqrt(3)/2,0,1/2]])
 
 class SHCoeffs:
     """An SHCoeffs object stores real spherical harmonic coefficients for even
@@ -45,11 +54,11 @@ class SHCoeffs:
             return SHCoeffs(np.array(self.coeffs)*other)
 
         # Pad inputs
-        x1 = np.pad(np.array(self.coeffs), (0, 2*(self.lmax + 2) + 1), 'constant')
-        x2 = np.pad(np.array(other.coeffs), (0, 2*(self.lmax + 2) + 1), 'constant')
+        x1 = np.pad(np.array(self.coeffs), (0, 15 - len(self.coeffs)), 'constant')
+        x2 = np.pad(np.array(other.coeffs), (0, 15 - len(other.coeffs)), 'constant')
 
         # Multiply
-        result = np.dot(np.dot(G, x1), x2)
+        result = GS.multiply(x1, x2)
         
         return SHCoeffs(result)
 
@@ -64,7 +73,7 @@ class SHCoeffs:
         x1 = np.pad(np.array(self.coeffs), (0, 15 - len(self.coeffs)), 'constant')
         x2 = np.pad(np.array(other.coeffs), (0, 15 - len(other.coeffs)), 'constant')
 
-        mat = np.einsum('jls,s->jl', G, x2)
+        mat = GS.matrix(x2)
         mat_inv = np.linalg.inv(mat)
         result = np.einsum('jl,l->j', mat_inv, x1)
 
@@ -78,13 +87,7 @@ class SHCoeffs:
     def rotate(self):
         # Only rotate by 90 degrees about the y axis for diSPIM.
         # Generalize later.
-        m = np.array([[1,0,0,0,0,0],
-                      [0,0,1,0,0,0], # Careful with -1 here
-                      [0,1,0,0,0,0],
-                      [0,0,0,-1/2,0,np.sqrt(3)/2],
-                      [0,0,0,0,1,0],
-                      [0,0,0,np.sqrt(3)/2,0,1/2]])
-        return SHCoeffs(np.dot(m, self.coeffs))
+        return SHCoeffs(np.dot(R, self.coeffs))
     
     def plot(self, folder=''):
         if not os.path.exists(folder):
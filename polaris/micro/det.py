@@ -4,14 +4,21 @@ import polaris.harmonics.tfcoeffs as tf
 import polaris.util as util
 from scipy import special
 
+# Radial OTF tables shared by all detectors, keyed on (alpha, lut_samples)
+_radial_tables = {}
+
 class Detector:
     """A Detector is specified by its optical axis, numerical aperture, 
     the index of refraction of the sample, and precence of a polarizer.
 
     By default we use the paraxial approximation.
+
+    If lut_samples is set, H_grid interpolates into a radial table with that
+    many samples on 0 <= nu <= 2 instead of evaluating A1 and A2 directly.
     """
     def __init__(self, optical_axis=[0,0,1], na=0.8, n=1.33, sigma_ax=1.0,
-                 polarizer=False, paraxial=True, detect_all=False):
+                 polarizer=False, paraxial=True, detect_all=False,
+                 lut_samples=None):
         self.optical_axis = optical_axis
         self.na = na
         self.n = n
@@ -20,6 +27,7 @@ class Detector:
         self.paraxial = paraxial
         self.detect_all = detect_all
         self.sigma_ax = sigma_ax
+        self.lut_samples = lut_samples
 
     def h(self, x, y, z):
         if self.detect_all:
@@ -80,7 +88,53 @@ class Detector:
 
         ax_weight = np.exp(-(z_ax**2)/(2*(self.sigma_ax**2)))
         return sh.SHCoeffs(n0)*ax_weight
+
+    def H_grid(self, x, y, z):
+        # Array version of H. Evaluates the detection transfer function on
+        # broadcastable frequency arrays and returns the l <= 2 coefficients
+        # along the last axis.
+        x, y, z = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in (x, y, z)])
+        out = np.zeros(x.shape + (6,))
+        if self.detect_all:
+            out[...,0] = 1.0
+            return out
+
+        # Find cylindrical coordinates based on view
+        if self.optical_axis == [0,0,1]: # z-detection
+            nu = np.sqrt(x**2 + y**2)
+            z_ax = z
+        elif self.optical_axis == [1,0,0]: # x-detection
+            nu = np.sqrt(y**2 + z**2)
+            z_ax = x
+
+        if self.lut_samples:
+            nu_tab, n0_tab = self.radial_table()
+            out[...,0] = np.interp(nu, nu_tab, n0_tab[:,0], right=0)
+            out[...,3] = np.interp(nu, nu_tab, n0_tab[:,1], right=0)
+        else:
+            A1 = self.A1(nu)
+            A2 = self.A2(nu)
+            out[...,0] = A1 + (self.alpha**2/4)*A2
+            out[...,3] = (-A1 + (self.alpha**2/2)*A2)/np.sqrt(5)
+        if self.optical_axis == [1,0,0]: # x-detection
+            out = np.einsum('ij,...j->...i', sh.R, out)
+
+        ax_weight = np.exp(-(z_ax**2)/(2*(self.sigma_ax**2)))
+        return out*ax_weight[...,None]
     
+    def radial_table(self):
+        # The unrotated coefficients depend on frequency only through nu and
+        # vanish for nu >= 2, so tabulate the two nonzero ones once.
+        key = (self.alpha, self.lut_samples)
+        if key not in _radial_tables:
+            nu = np.linspace(0, 2, self.lut_samples)
+            A1 = self.A1(nu)
+            A2 = self.A2(nu)
+            n0 = np.stack([A1 + (self.alpha**2/4)*A2,
+                           (-A1 + (self.alpha**2/2)*A2)/np.sqrt(5)], axis=-1)
+            _radial_tables[key] = (nu, n0)
+        return _radial_tables[key]
+
     # PSF helper functions
     def a1(self, r):
         if r == 0:
@@ -97,14 +151,14 @@ class Detector:
     # OTF helper functions
     def myacos(self, r):
         if isinstance(r, np.ndarray):
-            r[np.abs(r) < 2] = 2
+            r = np.minimum(np.abs(r), 2)
         else:
             r = r if abs(r) < 2 else 2
         return np.arccos(np.abs(r/2))
 
     def mysqrt(self, r):
         if isinstance(r, np.ndarray):
-            r[np.abs(r) < 2] = 2
+            r = np.minimum(np.abs(r), 2)
         else:
             r = r if abs(r) < 2 else 2
         return (np.abs(r/2))*np.sqrt(1 - (np.abs(r/2))**2)
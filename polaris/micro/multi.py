@@ -1,4 +1,4 @@
-from polaris import util, viz, data, spang
+from polaris import util, viz, data, spang, cache, noise, fourier
 from polaris.micro import ill, det, micro
 from polaris.harmonics import shcoeffs
 import numpy as np
@@ -14,15 +14,36 @@ import os
 import subprocess
 from tqdm import tqdm
 
+class View:
+    """A View holds the separable paraxial transfer function of one view.
+
+    axis is the detection axis (0, 1 or 2) and taxes the two transverse axes
+    in increasing order. Ht (... x J x P) is sampled on the nonnegative
+    frequencies of the transverse axes and Ha on those of the detection
+    axis, so H = Ht(taxes)*Ha(axis). support marks the transverse
+    frequencies where Ht is nonzero (inside the detection OTF cutoff).
+    """
+    def __init__(self, axis, Ht, Ha):
+        self.axis = axis
+        self.taxes = tuple(a for a in range(3) if a != axis)
+        self.Ht = Ht
+        self.Ha = Ha
+        self.support = np.any(Ht != 0, axis=(-2,-1))
+
 class MultiMicroscope:
     """A MultiMicroscope represents an experiment that collects intensity data 
     under several different conditions (different polarization states or 
     illumination schemes).
 
     A MultiMicroscope mainly consists of a list of Microscopes.
+
+    If cache_dir is set, calc_H stores H there under a hash of everything
+    that determines it and reuses it for later identical microscopes.
+    cache_size limits the folder size in bytes.
     """
     def __init__(self, spang, data, sigma_ax=0.25, n_samp=1.33, lamb=525,
-                 spang_coupling=True):
+                 spang_coupling=True, lut_samples=None, cache_dir=None,
+                 cache_size=None):
 
         self.spang = spang
         self.data = data
@@ -34,6 +55,12 @@ class MultiMicroscope:
         self.P = data.P                
         self.V = data.V
         
+        # The paraxial detector is only modelled along +z and +x
+        for v, axis in enumerate(data.det_optical_axes):
+            if list(axis) not in ([0,0,1], [1,0,0]):
+                raise ValueError('View '+str(v)+' detection axis '+str(list(axis))+
+                                 ' is not supported, use [0,0,1] or [1,0,0]')
+
         m = [] # List of microscopes
 
         # Cycle through paths
@@ -41,13 +68,21 @@ class MultiMicroscope:
             ill_ = ill.Illuminator(optical_axis=data.ill_optical_axes[i],
                                    na=data.ill_nas[i], n=n_samp)
             det_ = det.Detector(optical_axis=data.det_optical_axes[i],
-                                na=data.det_nas[i], n=n_samp, sigma_ax=sigma_ax)
+                                na=data.det_nas[i], n=n_samp, sigma_ax=sigma_ax,
+                                lut_samples=lut_samples)
             m.append(micro.Microscope(ill=ill_, det=det_, spang_coupling=spang_coupling)) # Add microscope
 
         self.micros = m
         self.lamb = lamb
         self.sigma_ax = sigma_ax
+        self.n_samp = n_samp
+        self.lut_samples = lut_samples
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = cache.Cache(cache_dir, max_bytes=cache_size)
         self.jmax = m[0].h(0, 0, 0).jmax
+        self.svd = None # Cached per-frequency SVD of H, see calc_svd
+        self.views = None # One View per detection path, see compute_H
 
     def calc_point_H(self, vx, vy, vz, v):
         out = np.zeros((self.J, self.P))
@@ -57,202 +92,428 @@ class MultiMicroscope:
             out[:,p] = tf.coeffs
         return out # return j x p
     
-    def calc_H(self):
-        # Transverse transfer function
-        log.info('Computing H for view 0')
-        dx = np.fft.rfftfreq(self.X, d=self.data.vox_dim[0])*self.lamb/self.micros[0].det.na
-        dy = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])*self.lamb/self.micros[0].det.na
-        dz = np.fft.rfftfreq(self.Z, d=self.data.vox_dim[2])*self.lamb/self.micros[0].det.na
-        self.Hxy = np.zeros((dx.shape[0], dy.shape[0], self.J, self.P), dtype=np.float32)
-
-        # Calc illumination once
-        sh_ills = []
-        for p in range(self.P):
-            pol = self.data.pols_norm[0,p,:]
-            sh_ills.append(self.micros[0].ill.H(pol))
-
-        # Calc detection and multiply
-        for x, nux in enumerate(tqdm(dx)):
-            for y, nuy in enumerate(dy):
-                for p, sh_ill in enumerate(sh_ills):
-                    self.Hxy[x,y,:,p] = (sh_ill*self.micros[0].det.H(nux,nuy,0)).coeffs
-        self.Hxy = self.Hxy/np.max(np.abs(self.Hxy))
-        if self.micros[0].spang_coupling:
-            self.Hz = np.exp(-(dz**2)/(2*(self.sigma_ax**2)), dtype=np.float32)
+    def calc_H(self, n_jobs=-1):
+        if self.cache is not None:
+            key = self.H_key()
+            files = self.cache.load(key)
+            if files is not None:
+                self.set_H(files)
+                return
+        self.compute_H(n_jobs=n_jobs)
+        if self.cache is not None:
+            self.cache.save(key, **self.H_files())
+
+    def H_key(self):
+        # Everything that determines H
+        return cache.key({'model': 'paraxial',
+                          'shape': [self.X, self.Y, self.Z, self.J],
+                          'vox_dim': list(self.data.vox_dim),
+                          'ill_nas': list(self.data.ill_nas),
+                          'det_nas': list(self.data.det_nas),
+                          'ill_optical_axes': self.data.ill_optical_axes,
+                          'det_optical_axes': self.data.det_optical_axes,
+                          'pols_norm': self.data.pols_norm,
+                          'lamb': self.lamb, 'n_samp': self.n_samp,
+                          'sigma_ax': self.sigma_ax,
+                          'spang_coupling': self.micros[0].spang_coupling,
+                          'lut_samples': self.lut_samples})
+
+    def compute_H(self, n_jobs=-1):
+        # Every view is built by the same code in its own worker thread
+        from joblib import Parallel, delayed
+        self.views = Parallel(n_jobs=n_jobs, backend='threading')(
+            [delayed(self.compute_view)(v) for v in range(self.V)])
+        self.svd = None
+
+    def compute_view(self, v):
+        log.info('Computing H for view '+str(v))
+        axis = self.det_axis(v)
+        shape = (self.X, self.Y, self.Z)
+        freqs = [np.fft.rfftfreq(shape[i], d=self.data.vox_dim[i])*self.lamb/self.micros[v].det.na
+                 for i in range(3)]
+        t0, t1 = [a for a in range(3) if a != axis]
+
+        # Calc illumination once, then detection on the transverse plane
+        # (zero axial frequency) and multiply
+        coords = [0, 0, 0]
+        coords[t0] = freqs[t0][:,None]
+        coords[t1] = freqs[t1][None,:]
+        sh_ills = self.calc_ill_coeffs(v)
+        sh_det = self.micros[v].det.H_grid(*coords)
+        Ht = self.combine_H(sh_ills, sh_det)
+        Ht = Ht/np.max(np.abs(Ht))
+
+        # Axial blur along the detection axis
+        if self.micros[v].spang_coupling:
+            Ha = np.exp(-(freqs[axis]**2)/(2*(self.sigma_ax**2)), dtype=np.float32)
         else:
-            self.Hz = np.ones(dz.shape, dtype=np.float32)
+            Ha = np.ones(freqs[axis].shape, dtype=np.float32)
+        return View(axis, Ht, Ha)
+
+    def det_axis(self, v):
+        # The paraxial model separates only along a coordinate axis
+        axis = np.abs(np.array(self.data.det_optical_axes[v], dtype=float))
+        if np.count_nonzero(axis) != 1:
+            raise ValueError('View '+str(v)+' detection axis '+str(self.data.det_optical_axes[v])+
+                             ' is not a coordinate axis')
+        return int(np.argmax(axis))
+
+    # Names of the original two-view (z then x detection) layout
+    @property
+    def Hxy(self):
+        return self.views[0].Ht
+
+    @property
+    def Hz(self):
+        return self.views[0].Ha
+
+    @property
+    def Hyz(self):
+        return self.views[1].Ht
 
-        log.info('Computing H for view 1')
-        dx = np.fft.rfftfreq(self.X, d=self.data.vox_dim[0])*self.lamb/self.micros[1].det.na
-        dy = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])*self.lamb/self.micros[1].det.na
-        dz = np.fft.rfftfreq(self.Z, d=self.data.vox_dim[2])*self.lamb/self.micros[1].det.na
-        self.Hyz = np.zeros((dy.shape[0], dz.shape[0], self.J, self.P), dtype=np.float32)
+    @property
+    def Hx(self):
+        return self.views[1].Ha
 
-        # Calc illumination once
-        sh_ills = []
+    def calc_ill_coeffs(self, v):
+        # Illumination coefficients for every polarizer in view v (P x 6)
+        out = np.zeros((self.P, 6))
         for p in range(self.P):
-            pol = self.data.pols_norm[1,p,:]
-            sh_ills.append(self.micros[1].ill.H(pol))
-
-        # Calc detection and multiply            
-        for y, nuy in enumerate(tqdm(dy)):
-            for z, nuz in enumerate(dz):
-                for p, sh_ill in enumerate(sh_ills):
-                    self.Hyz[y,z,:,p] = (sh_ill*self.micros[1].det.H(0,nuy,nuz)).coeffs
-        self.Hyz = self.Hyz/np.max(np.abs(self.Hyz))
-        if self.micros[0].spang_coupling:
-            self.Hx = np.exp(-(dx**2)/(2*(self.sigma_ax**2)))
-        else:
-            self.Hx = np.ones(dx.shape)
-            
+            pol = self.data.pols_norm[v,p,:]
+            out[p,:] = self.micros[v].ill.H(pol).coeffs
+        return out
+
+    def combine_H(self, sh_ills, sh_det):
+        # Multiply every illumination vector (P x 6) with the detection
+        # coefficients on a frequency grid (... x 6) through the Gaunt tensor.
+        # Same product as SHCoeffs.__mul__, batched over the grid and P.
+        G = shcoeffs.G[:self.J,:6,:6]
+        return np.einsum('jls,pl,...s->...jp', G, sh_ills, sh_det,
+                         optimize=True).astype(np.float32)
+
     def lake_response(self):
-        e0 = self.calc_point_H(0, 0, 0, 0)[0,:]
-        e1 = self.calc_point_H(0, 0, 0, 1)[0,:]
-        return np.vstack([e0, e1])
+        return np.vstack([self.calc_point_H(0, 0, 0, v)[0,:] for v in range(self.V)])
     
     def save_H(self, filename):
-        np.savez(filename, Hxy=self.Hxy, Hyz=self.Hyz, Hx=self.Hx, Hz=self.Hz)
+        np.savez(filename, **self.H_files())
         
     def load_H(self, filename):
-        files = np.load(filename)
-        self.Hxy = files['Hxy']
-        self.Hyz = files['Hyz']
-        self.Hx = files['Hx']        
-        self.Hz = files['Hz']
+        self.set_H(np.load(filename))
+
+    def H_files(self):
+        files = {}
+        for v, view in enumerate(self.views):
+            files['Ht'+str(v)] = view.Ht
+            files['Ha'+str(v)] = view.Ha
+        return files
+
+    def set_H(self, files):
+        if 'Hxy' in files: # Files saved before per-view storage
+            self.views = [View(2, files['Hxy'], files['Hz']),
+                          View(0, files['Hyz'], files['Hx'])]
+        else:
+            self.views = [View(self.det_axis(v), files['Ht'+str(v)], files['Ha'+str(v)])
+                          for v in range(self.V)]
+        self.svd = None
         
-    def fwd(self, f, snr=None):
+    def fwd(self, f, snr=None, seed=None, noise_model=None, normalize=True):
         log.info('Applying forward operator')
 
         # Truncate spang for angular bandlimit
         f = f[:,:,:,:self.jmax]
 
         # 3D FT
-        F = np.fft.rfftn(f, axes=(0,1,2))
-        
+        F = fourier.rfftn(f, axes=(0,1,2)).astype(np.complex64)
+
         # Tensor multiplication
-        G = np.zeros(F.shape[0:3] + (self.P,) + (self.V,), dtype=np.complex64)
-        for x in tqdm(range(self.Hxy.shape[0])):
-            for y in range(self.Hxy.shape[1]):
-                Hzsp = np.einsum('z,sp->zsp', self.Hz, self.Hxy[x,y,:,:])
-                G[x,y,:,:,0] = np.einsum('zsp,zs->zp', Hzsp, F[x,y,:,:])
-                G[-x,y,:,:,0] = np.einsum('zsp,zs->zp', Hzsp, F[-x,y,:,:])
-                G[x,-y,:,:,0] = np.einsum('zsp,zs->zp', Hzsp, F[x,-y,:,:])
-                G[-x,-y,:,:,0] = np.einsum('zsp,zs->zp', Hzsp, F[-x,-y,:,:])
-
-        start = slice(0, (self.X//2)+1)
-        end = slice(None, -(self.X//2), -1)
-        for y in tqdm(range(self.Hyz.shape[0])):
-            for z in range(self.Hyz.shape[1]):
-                Hxsp = np.einsum('x,sp->xsp', self.Hx, self.Hyz[y,z,:,:])
-                G[start,y,z,:,1] = np.einsum('xsp,xs->xp', Hxsp, F[start,y,z,:])
-                G[end,y,z,:,1] = np.einsum('xsp,xs->xp', Hxsp[1:-1], F[end,y,z,:])
-                G[start,-y,z,:,1] = np.einsum('xsp,xs->xp', Hxsp, F[start,-y,z,:])
-                G[end,-y,z,:,1] = np.einsum('xsp,xs->xp', Hxsp[1:-1], F[end,-y,z,:])
+        G = self.apply_H(F)
+        del F
 
         # 3D IFT
-        g = np.fft.irfftn(G, s=f.shape[0:3], axes=(0,1,2))
+        g = fourier.irfftn(G, s=f.shape[0:3], axes=(0,1,2))
 
         # Clip negatives (sometimes useful in simulation)
         # g = np.clip(g, 0, None) 
         
-        # Apply Poisson noise
-        if snr is not None:
-            norm = snr**2/np.max(g)
-            arr_poisson = np.vectorize(np.random.poisson)
-            g = arr_poisson(g*norm)/norm
+        # Apply Poisson noise (or any noise.Noise camera model)
+        if noise_model is None and snr is not None:
+            noise_model = noise.Noise(snr=snr, seed=seed)
+        if noise_model is not None:
+            g = noise_model.realize(g, dtype=g.dtype)
 
-        # return g
+        if not normalize: # The linear map that adj is the adjoint of
+            return g
         return g/np.max(g)
+
+    def adj(self, g):
+        # Adjoint of the (unnormalized, noise-free) forward operator
+        G = fourier.rfftn(g, axes=(0,1,2)).astype(np.complex64)
+        F = self.apply_HT(G)
+        del G
+        return fourier.irfftn(F, s=g.shape[0:3], axes=(0,1,2))
+
+    def as_linear_operator(self):
+        # fwd(normalize=False) and adj as a scipy LinearOperator on flattened
+        # spang (X*Y*Z*J) and data (X*Y*Z*P*V) arrays
+        return util.linear_operator(lambda f: self.fwd(f, normalize=False), self.adj,
+                                    (self.X, self.Y, self.Z, self.J),
+                                    (self.X, self.Y, self.Z, self.P, self.V))
+
+    def apply_H(self, F):
+        # Multiply a spang spectrum (X x Y x Z/2+1 x J) by H. Every view
+        # factors as Ht(taxes)Ha(axis), so it is one matmul batched over its
+        # transverse plane.
+        # Only transverse frequencies in the view's support are multiplied.
+        G = np.zeros(F.shape[0:3] + (self.P, self.V), dtype=np.complex64)
+        for v, view in enumerate(self.views):
+            Ht, Ha, supp = self.view_fft_H(view)
+            perm = view.taxes + (view.axis, 3)
+            Ft = F.transpose(perm)
+            Gv = np.zeros(Ft.shape[0:3] + (self.P,), dtype=np.complex64)
+            Gv[supp] = np.matmul(Ft[supp], Ht[supp])*Ha[:,None]
+            G[...,v] = Gv.transpose(np.argsort(perm))
+        return G
+
+    def apply_HT(self, G):
+        # Multiply a data spectrum (X x Y x Z/2+1 x P x V) by H^T. H is real
+        # so this is the adjoint of apply_H.
+        F = np.zeros(G.shape[0:3] + (self.J,), dtype=np.complex64)
+        for v, view in enumerate(self.views):
+            Ht, Ha, supp = self.view_fft_H(view)
+            perm = view.taxes + (view.axis, 3)
+            Gv = G[...,v].transpose(perm)
+            Fv = np.zeros(Gv.shape[0:3] + (self.J,), dtype=np.complex64)
+            Fv[supp] = np.matmul(Gv[supp]*Ha[:,None], np.swapaxes(Ht[supp], -1, -2))
+            F += Fv.transpose(np.argsort(perm))
+        return F
+
+    def view_fft_H(self, view):
+        # Ht, Ha and the support of a view indexed like the rfftn grid (full
+        # x and y, half z)
+        shape = (self.X, self.Y)
+        Ht = view.Ht
+        supp = view.support
+        for i, a in enumerate(view.taxes):
+            if a < 2:
+                Ht = np.take(Ht, util.rfftmirror(shape[a]), axis=i)
+                supp = np.take(supp, util.rfftmirror(shape[a]), axis=i)
+        Ha = view.Ha
+        if view.axis < 2:
+            Ha = Ha[util.rfftmirror(shape[view.axis])]
+        return Ht.astype(np.float32), Ha.astype(np.float32), supp
     
-    def fwd_angular(self, f, snr=None, mask=None):
+    def fwd_angular(self, f, snr=None, mask=None, chunk=2**16):
+        # Forward model without spatial blurring, applied voxel by voxel as
+        # one gathered matrix multiply over the voxels selected by mask (a
+        # boolean volume or precomputed voxel indices, see masked_voxels).
         log.info('Applying angular forward operator')
-        g = np.zeros(self.data.g.shape)
-        H = np.zeros((self.J, self.P, self.V))
-        H[:,:,0] = self.calc_point_H(0, 0, 0, 0, self.data.pols_norm)
-        H[:,:,1] = self.calc_point_H(0, 0, 0, 1, self.data.pols_norm)
-
-        # Setup mask
-        if mask is None:
-            mask = np.ones((self.X, self.Y, self.Z))
+        HH = np.reshape(self.calc_angular_H(), (self.J, self.P*self.V))
+        ff = np.reshape(f, (-1, f.shape[-1]))[:,:self.J]
+        g = np.zeros((self.X*self.Y*self.Z, self.P*self.V))
 
         # Main calculation
-        for x in tqdm(range(self.X)):
-            for y in range(self.Y):
-                for z in range(self.Z):
-                    if mask[x,y,z]:
-                        g[x,y,z,:,:] = np.einsum('spv,s->pv', H, f[x,y,z,:])
+        idx = self.masked_voxels(mask)
+        for i in range(0, len(idx), chunk):
+            ii = idx[i:i + chunk]
+            g[ii] = np.matmul(ff[ii], HH)
+        g = np.reshape(g, (self.X, self.Y, self.Z, self.P, self.V))
         return g/np.max(g)
 
-    def pinv(self, g, eta=0, padding=True):
+    def pinv(self, g, eta=0, padding=True, n_jobs=-1, chunk=4, solver='auto'):
+        # Once calc_svd has run (also implicitly through pinv_sweep, pmeas or
+        # pnull) solver='auto' and 'svd' reuse its factors; 'gram' still
+        # solves every frequency
+        if self.svd is not None and solver in ('auto', 'svd'):
+            return next(self.pinv_sweep(g, [eta], n_jobs=n_jobs, chunk=chunk))[1]
+
         # 3D FT
         log.info('Taking 3D Fourier transform')        
-        G = np.fft.rfftn(g, axes=(0,1,2))
+        G = fourier.rfftn(g, axes=(0,1,2)).astype(np.complex64)
         G2 = np.reshape(G, G.shape[0:3] + (self.P*self.V,))
-        
-        xstart = slice(0, (self.X//2)+1)
-        xend = slice(None, -(self.X//2), -1)
-        ystart = slice(0, (self.Y//2)+1)
-        yend = slice(None, -(self.Y//2), -1)
 
+        # Each worker thread solves a chunk of z-slabs and writes into F.
+        # H and G2 are shared, not copied.
         log.info('Applying pseudoinverse operator')
-        import multiprocessing as mp
-        pool = mp.Pool(processes=1)#mp.cpu_count())
-        args = []
-
-        for z in range(self.Hz.shape[0]):
-            args.append((z, G2[:,:,z,:], self.Hxy, self.Hyz[:,z,:,:], self.Hx, self.Hz, self.X, self.Y, self.J, self.P, self.V, eta, xstart, xend, ystart, yend))
-        result = list(tqdm(pool.imap(compute_pinv, args), total=len(args)))
-        F = np.array(result)
-        del result
-        
+        F = np.zeros(G2.shape[0:3] + (self.J,), dtype=np.complex64)
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            tqdm([delayed(self.compute_pinv)(F, G2, zs, eta, solver) for zs in self.zslabs(chunk)]))
+        del G, G2
+
         # 3D IFT
         log.info('Taking inverse 3D Fourier transform')        
-        f = np.fft.irfftn(np.moveaxis(F, 0, 2), s=g.shape[0:3], axes=(0,1,2))
+        f = fourier.irfftn(F, s=g.shape[0:3], axes=(0,1,2))
 
         return f
+
+    def calc_svd(self, n_jobs=-1, chunk=4):
+        # Factor H = u s vh once at every frequency of the rfftfreq grid.
+        # Only s/(s**2 + eta) depends on eta, so pinv and pinv_sweep can
+        # reuse the factors for any regularization.
+        log.info('Computing SVD of H')
+        shape = (self.X//2 + 1, self.Y//2 + 1, self.Z//2 + 1)
+        k = min(self.J, self.P*self.V)
+        u = np.zeros(shape + (self.J, k), dtype=np.float32)
+        s = np.zeros(shape + (k,), dtype=np.float32)
+        vh = np.zeros(shape + (k, self.P*self.V), dtype=np.float32)
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            tqdm([delayed(self.compute_svd)(u, s, vh, zs) for zs in self.zslabs(chunk)]))
+        self.svd = (u, s, vh)
+
+    def compute_svd(self, u, s, vh, zs):
+        # Out-of-band frequencies keep s = 0, so every solver maps them to 0
+        supp = self.support(zs)
+        u[:,:,zs][supp], s[:,:,zs][supp], vh[:,:,zs][supp] = np.linalg.svd(
+            self.calc_HH(zs)[supp], full_matrices=False)
+
+    def pinv_sweep(self, g, etas, folder=None, n_jobs=-1, chunk=4):
+        # Generator of (eta, f) pseudoinverse solutions for every eta in etas.
+        # The data is projected onto the singular vectors once; each eta then
+        # costs a rescaling and one inverse 3D FT. If folder is given, each
+        # solution is also saved to folder/f-<repr(eta)>.npy as it is
+        # produced.
+        if self.svd is None:
+            self.calc_svd(n_jobs=n_jobs, chunk=chunk)
+        u, s, vh = self.svd
+        from joblib import Parallel, delayed
+
+        log.info('Projecting data onto singular vectors')
+        G = fourier.rfftn(g, axes=(0,1,2)).astype(np.complex64)
+        G2 = np.reshape(G, G.shape[0:3] + (self.P*self.V,))
+        C = np.zeros(G2.shape[0:3] + s.shape[-1:], dtype=np.complex64)
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            [delayed(self.apply_mirrored)(C, vh[:,:,zs], G2[:,:,zs], zs) for zs in self.zslabs(chunk)])
+        del G, G2
+
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder)
+        for eta in etas:
+            log.info('Applying pseudoinverse operator with eta = '+str(eta))
+            F = np.zeros(C.shape[0:3] + (self.J,), dtype=np.complex64)
+            Parallel(n_jobs=n_jobs, backend='threading')(
+                [delayed(self.compute_pinv_svd)(F, C, zs, eta) for zs in self.zslabs(chunk)])
+            f = fourier.irfftn(F, s=g.shape[0:3], axes=(0,1,2))
+            del F
+            if folder is not None:
+                np.save(os.path.join(folder, 'f-{!r}.npy'.format(float(eta))), f)
+            yield eta, f
+
+    def compute_pinv_svd(self, F, C, zs, eta):
+        u, s, vh = self.svd
+        s = s[:,:,zs]
+        sreg = np.where(s > 1e-7, s/(s**2 + eta), 0) # Regularize
+        self.apply_mirrored(F, u[:,:,zs]*sreg[...,None,:], C[:,:,zs], zs)
+
+    def zslabs(self, chunk):
+        Zr = self.Z//2 + 1
+        return [slice(z, min(z + chunk, Zr)) for z in range(0, Zr, chunk)]
+
+    def support(self, zs=slice(None)):
+        # Frequencies of the half grid slab (x, y, zs) where any view's H is
+        # nonzero
+        shape = (self.X//2 + 1, self.Y//2 + 1, self.Z//2 + 1)
+        supp = np.zeros(shape, dtype=bool)[:,:,zs]
+        for view in self.views:
+            vs = np.expand_dims(view.support, view.axis)
+            if view.axis != 2:
+                vs = vs[:,:,zs]
+            supp = supp | vs
+        return supp
+
+    def calc_HH(self, zs):
+        # System matrices (J x PV) on the rfftfreq grid for a slab of z
+        Hs = np.broadcast_arrays(*[self.view_slab_H(view, zs) for view in self.views])
+        HH = np.stack(Hs, axis=-1).astype(np.float32)
+        return np.reshape(HH, HH.shape[0:3] + (self.J, self.P*self.V))
+
+    def view_slab_H(self, view, zs):
+        # Ht*Ha of a view broadcastable to the half grid slab (x, y, zs, J, P)
+        Ht = np.expand_dims(view.Ht, view.axis)
+        shape = 5*[1]
+        shape[view.axis] = -1
+        Ha = np.reshape(view.Ha, shape)
+        if view.axis == 2:
+            Ha = Ha[:,:,zs]
+        else:
+            Ht = Ht[:,:,zs]
+        return Ht*Ha
+
+    def compute_pinv(self, F, G2, zs, eta, solver='auto'):
+        # Solve only inside the support; F is zero out of band
+        supp = self.support(zs)
+        HH = self.calc_HH(zs)
+        Pinv = np.zeros(HH.shape, dtype=np.float32)
+        Pinv[supp] = util.tikhonov_pinv(HH[supp], eta=eta, solver=solver)
+        self.apply_mirrored(F, Pinv, G2[:,:,zs], zs)
+
+    def apply_mirrored(self, F, M, G2, zs):
+        # F[x,y,z] = M[|x|,|y|,z] G2[x,y,z] for a slab of z. M and G2 hold
+        # only the slab.
+        for fx, hx in util.rfftmirror_slices(self.X):
+            for fy, hy in util.rfftmirror_slices(self.Y):
+                F[fx,fy,zs,:] = np.matmul(M[hx,hy], G2[fx,fy,:,:,None])[...,0]
     
-    def pinv_angular(self, g, eta=0, mask=None):
+    def pinv_angular(self, g, eta=0, mask=None, chunk=2**16):
         log.info('Applying pseudoinverse operator')
-        f = np.zeros(self.spang.f.shape)
+        HH = np.reshape(self.calc_angular_H(), (self.J, self.P*self.V))
+        M = util.tikhonov_pinv(HH, eta=eta, solver='svd')
+        gg = np.reshape(g, (-1, self.P*self.V))
+        f = np.zeros((self.X*self.Y*self.Z, self.J))
+
+        # Main calculation
+        idx = self.masked_voxels(mask)
+        for i in range(0, len(idx), chunk):
+            ii = idx[i:i + chunk]
+            f[ii] = np.matmul(gg[ii], M.T) # Apply Pinv
+        return np.reshape(f, (self.X, self.Y, self.Z, self.J))
+
+    def calc_angular_H(self):
         H = np.zeros((self.J, self.P, self.V))
-        H[:,:,0] = self.calc_point_H(0, 0, 0, 0, self.data.pols_norm)
-        H[:,:,1] = self.calc_point_H(0, 0, 0, 1, self.data.pols_norm)
-        HH = np.reshape(H, (self.J, self.P*self.V))
-        u, s, vh = np.linalg.svd(HH, full_matrices=False) # Find SVD
-        sreg = np.where(s > 1e-7, s/(s**2 + eta), 0) # Regularize
-        M = np.einsum('lm,m,mn->ln', u, sreg, vh)
+        for v in range(self.V):
+            H[:,:,v] = self.calc_point_H(0, 0, 0, v)
+        return H
 
-        # Setup mask
+    def masked_voxels(self, mask=None):
+        # Flat voxel indices from None (every voxel), a boolean X x Y x Z
+        # mask, a tuple of index arrays like np.nonzero returns, or flat
+        # indices that were already computed
         if mask is None:
-            mask = np.ones((self.X, self.Y, self.Z))
+            return np.arange(self.X*self.Y*self.Z)
+        if isinstance(mask, tuple):
+            return np.ravel_multi_index(mask, (self.X, self.Y, self.Z))
+        mask = np.asarray(mask)
+        if mask.dtype == bool:
+            return np.flatnonzero(mask)
+        return mask.ravel()
+        
+    def pmeas(self, f, eta=0, n_jobs=-1, chunk=4):
+        # Projection H+H onto the measurement space
+        return self.project(f, eta=eta, null=False, n_jobs=n_jobs, chunk=chunk)
 
-        gg = np.reshape(g, (self.X, self.Y, self.Z, self.P*self.V))
+    def pnull(self, f, eta=0, n_jobs=-1, chunk=4):
+        # Projection I - H+H onto the null space
+        return self.project(f, eta=eta, null=True, n_jobs=n_jobs, chunk=chunk)
 
-        # Main calculation
-        for x in tqdm(range(self.X)):
-            for y in range(self.Y):
-                for z in range(self.Z):
-                    if mask[x,y,z]:
-                        f[x,y,z,:] = np.einsum('ln,n->l', M, gg[x,y,z,:]) # Apply Pinv
-        return f
-        
-    def pmeas(self, f, eta=0):
-        return self.pinv(self.fwd(f), eta=eta)
-
-    def pnull(self, f):
-        return f - self.pmeas(f) # could be made more efficient
-
-def compute_pinv(args):
-    z, G2, Hxy, Hyz, Hx, Hz, X, Y, J, P, V, eta, xstart, xend, ystart, yend = args
-    H0 = Hz[z]*Hxy[:,:,:,:]
-    H1 = np.einsum('x,ysp->xysp', Hx, Hyz[:,:,:])
-    HH = np.reshape(np.stack((H0, H1), axis=-1), H0.shape[0:2] + (J, P*V))
-    u, s, vh = np.linalg.svd(HH, full_matrices=False) # Find SVD
-    sreg = np.where(s > 1e-7, s/(s**2 + eta), 0) # Regularize
-    Pinv = np.einsum('xysv,xyv,xyvd->xysd', u, sreg, vh, optimize=True)
-    F = np.zeros((X, Y, J), dtype=np.complex64)
-    F[xstart,ystart,:] = np.einsum('xysd,xyd->xys', Pinv[:,:,:,:], G2[xstart,ystart,:])
-    F[xend,ystart,:] = np.einsum('xysd,xyd->xys', Pinv[1:-1,:,:,:], G2[xend,ystart,:])
-    F[xstart,yend,:] = np.einsum('xysd,xyd->xys', Pinv[:,1:-1,:,:], G2[xstart,yend,:])
-    F[xend,yend,:] = np.einsum('xysd,xyd->xys', Pinv[1:-1,1:-1,:,:], G2[xend,yend,:])
-    return F
+    def project(self, f, eta=0, null=False, n_jobs=-1, chunk=4):
+        # H+H = u diag(s**2/(s**2 + eta)) u^T at every frequency, so with the
+        # cached SVD a projection costs one forward and one inverse 3D FT
+        if self.svd is None:
+            self.calc_svd(n_jobs=n_jobs, chunk=chunk)
+        F = fourier.rfftn(f[...,:self.J], axes=(0,1,2)).astype(np.complex64)
+        PF = np.zeros(F.shape, dtype=np.complex64)
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            [delayed(self.compute_project)(PF, F, zs, eta) for zs in self.zslabs(chunk)])
+        if null:
+            PF = F - PF
+        del F
+        return fourier.irfftn(PF, s=f.shape[0:3], axes=(0,1,2))
+
+    def compute_project(self, PF, F, zs, eta):
+        u, s, vh = self.svd
+        u = u[:,:,zs]
+        s = s[:,:,zs]
+        w = np.where(s > 1e-7, s**2/(s**2 + eta), 0)
+        M = np.matmul(u*w[...,None,:], np.swapaxes(u, -1, -2))
+        self.apply_mirrored(PF, M, F[:,:,zs], zs)
@@ -2,6 +2,7 @@ import numpy as np
 import logging
 from tqdm import tqdm
 import os
+from polaris import util, cache, fourier
 
 log = logging.getLogger('log')
 
@@ -39,126 +40,187 @@ class Detector:
                                 [0, 0, 0, 0, 1, 0],
                                 [0, 0, 0, np.sqrt(3) / 2, 0, 1 / 2]])
 
-    def calc_H(self):
-        mtx = np.zeros((self.X, self.Y, self.Z, 6), dtype=np.complex64)
+        # Gaunt_633 indexed by the pupil components j, j' of B(j, j'), and
+        # rotated into the lab frame for x-detection
+        e = np.array([1, -1, 0]) + 1
+        self.Gaunt_B = self.Gaunt_633[:, e][:, :, e]
+        if self.optical_axis == [1, 0, 0]:
+            self.Gaunt_B = np.einsum('rs,sjk->rjk', self.rotate, self.Gaunt_B)
+
+        self.calc_pupil()
+
+    def calc_pupil(self):
+        # Everything in beta that does not depend on the axial position r,
+        # on the nonnegative transverse frequencies of the detection plane
+        self.vm = self.n / self.lamb
+        vc = self.na * 2 / self.lamb
+        if self.optical_axis == [1, 0, 0]:  # x-detection
+            d0 = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])
+            d1 = np.fft.rfftfreq(self.Z, d=self.data.vox_dim[2])
+            self.pupil_shape = (self.Y, self.Z)
+        else:  # z-detection
+            d0 = np.fft.rfftfreq(self.X, d=self.data.vox_dim[0])
+            d1 = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])
+            self.pupil_shape = (self.X, self.Y)
+
+        m0, m1 = np.meshgrid(d0, d1, indexing='ij')
+        nu = np.sqrt(m0 ** 2 + m1 ** 2)
+        outside = nu >= vc / 2
+        nu[outside] = self.vm - np.finfo(np.float32).eps
+        nu_phi = np.arctan2(m1, m0)
+        A_mat = self.A(nu, self.vm)
+        A_mat[outside] = 0
+
+        # A*g for the 2 x 3 pupil components (complex64), and nu for Phi,
+        # mirrored from the nonnegative frequencies onto the full fft grid
+        g = self.list_g()
+        i0 = util.rfftmirror(self.pupil_shape[0])[:, None]
+        i1 = util.rfftmirror(self.pupil_shape[1])[None, :]
+        self.pupil_Ag = np.array([[(A_mat * g[i][j](nu, nu_phi, self.vm))[i0, i1] for j in range(3)]
+                                  for i in range(2)], dtype=np.complex64)
+        self.pupil_nu = nu[i0, i1]
+
+    def calc_H(self, block=8, max_bytes=2**30):
+        # Detection H (X x Y x Z/2+1 x 6) built directly in rfftn layout.
+        # Defocus planes are propagated up to block planes at a time, see
+        # cal_betas; block=1 evaluates every plane directly. Blocks are
+        # shrunk so that all worker threads together hold at most about
+        # max_bytes of fields.
+        #
+        # The real-space PSF is even along the detection axis, so only the
+        # planes r >= 0 are computed (as float32) and their transform along
+        # that axis is the real cosine transform util.even_fft.
+        from joblib import Parallel, delayed, cpu_count
+        out = np.zeros((self.X, self.Y, self.Z // 2 + 1, 6), dtype=np.complex64)
+        # Per plane: 6 complex64 beta fields, the phase and the real B and
+        # output planes
+        plane = 8 * np.prod(self.pupil_shape) * (6 + 1 + 1 + 6)
+        block = int(max(1, min(block, max_bytes // (plane * cpu_count()))))
 
         if self.optical_axis == [0, 0, 1]:  # z-detection
             rz = np.fft.rfftfreq(self.Z, 1 / self.Z) * self.data.vox_dim[2]
             hz = np.exp(-(rz ** 2) / (2 * self.ls_sigma ** 2), dtype=np.float32)
 
-            temp = np.zeros((self.X, self.Y, rz.shape[0], 6), dtype=np.complex64)
-            from joblib import Parallel, delayed
+            temp = np.zeros((self.X, self.Y, rz.shape[0], 6), dtype=np.float32)
             Parallel(n_jobs=-1, backend='threading')(tqdm(
-                [delayed(self.compute_sh_det0)(temp, z, r, hz) for z, r in enumerate(rz)]))
-
-            start = slice(0, (self.Z // 2) + 1)
-            end = slice(None, -(self.Z // 2), -1)
+                [delayed(self.compute_sh_det0)(temp, zs, rz, hz) for zs in self.blocks(len(rz), block)]))
 
-            mtx[:, :, start, :] = temp
-            mtx[:, :, end, :] = temp[:, :, 1:-1, :]
-            mtx = mtx * 4 * np.pi / 3
+            temp = util.even_fft(temp, self.Z, axis=2)
+            for z in range(out.shape[2]):
+                fourier.fftn(temp[:, :, z], axes=(0, 1), out=out[:, :, z])
 
         if self.optical_axis == [1, 0, 0]:  # x-detection
             rx = np.fft.rfftfreq(self.X, 1 / self.X) * self.data.vox_dim[0]
             hx = np.exp(-(rx ** 2) / (2 * self.ls_sigma ** 2), dtype=np.float32)
 
-            temp = np.zeros((rx.shape[0], self.Y, self.Z, 6), dtype=np.complex64)
-            from joblib import Parallel, delayed
+            temp = np.zeros((rx.shape[0], self.Y, self.Z, 6), dtype=np.float32)
             Parallel(n_jobs=-1, backend='threading')(
-                tqdm([delayed(self.compute_sh_det1)(temp, x, r, hx) for x, r in enumerate(rx)]))
-
-            start = slice(0, (self.X // 2) + 1)
-            end = slice(None, -(self.X // 2), -1)
-            mtx[start, :, :, :] = temp
-            mtx[end, :, :, :] = temp[1:-1, :, :, :]
-
-            mtx = mtx * 4 * np.pi / 3
-            mtx = np.einsum('rs,xyzs->xyzr', self.rotate, mtx)
-
-        mtx = np.fft.rfftn(np.real(mtx), axes=(0, 1, 2))
+                tqdm([delayed(self.compute_sh_det1)(temp, xs, rx, hx) for xs in self.blocks(len(rx), block)]))
+
+            # Nonnegative kx only, then mirrored
+            temp = util.even_fft(temp, self.X, axis=0)
+            for x, x_ in enumerate(util.rfftmirror(self.X)):
+                fourier.rfftn(temp[x_], axes=(0, 1), out=out[x])
+
+        out *= 4 * np.pi / 3
+        return out
+
+    def field_key(self):
+        # Everything that determines calc_H
+        return cache.key({'model': 'completePSF-det',
+                          'shape': [self.X, self.Y, self.Z],
+                          'vox_dim': list(self.data.vox_dim),
+                          'optical_axis': self.optical_axis,
+                          'na': self.na, 'n': self.n, 'lamb': self.lamb,
+                          'ls_sigma': self.ls_sigma})
+
+    def field(self, disk_cache=None, memo=None):
+        # calc_H, reused from memo (a dict such as MultiMicroscope.fields) or
+        # from disk_cache (a cache.Cache)
+        key = self.field_key()
+        if memo is not None and key in memo:
+            return memo[key]
+        files = None if disk_cache is None else disk_cache.load(key)
+        if files is not None:
+            mtx = files['det']
+        else:
+            mtx = self.calc_H()
+            if disk_cache is not None:
+                disk_cache.save(key, det=mtx)
+        if memo is not None:
+            memo[key] = mtx
         return mtx
 
-    def compute_sh_det0(self, mtx, z, r, hz):
-        e = [1, -1, 0]
+    def support(self):
+        # The detection OTF is the autocorrelation of a pupil of radius vc/2,
+        # so it vanishes beyond transverse frequency vc. The light sheet only
+        # blurs along the detection axis. Returns an X x Y x Z/2+1 mask.
+        vc = self.na * 2 / self.lamb
+        kx = np.fft.fftfreq(self.X, d=self.data.vox_dim[0])[:, None, None]
+        ky = np.fft.fftfreq(self.Y, d=self.data.vox_dim[1])[None, :, None]
+        kz = np.fft.rfftfreq(self.Z, d=self.data.vox_dim[2])[None, None, :]
+        if self.optical_axis == [1, 0, 0]:  # x-detection
+            nu2 = ky ** 2 + kz ** 2 + 0 * kx
+        else:  # z-detection
+            nu2 = kx ** 2 + ky ** 2 + 0 * kz
+        return nu2 <= vc ** 2
+
+    def blocks(self, n, block):
+        return [slice(i, min(i + block, n)) for i in range(0, n, block)]
+
+    def compute_sh_det0(self, mtx, zs, rz, hz):
+        mtx[:, :, zs, :] = np.moveaxis(self.cal_sh(rz[zs]), 0, 2) * hz[zs, None]
+
+    def compute_sh_det1(self, mtx, xs, rx, hx):
+        mtx[xs, :, :, :] = self.cal_sh(rx[xs]) * hx[xs, None, None, None]
+
+    def cal_sh(self, rs):
+        # Re sum_jj' Gaunt_B[s, j, j'] B(j, j') for the planes rs (planes x
+        # pupil shape x 6, float32). Gaunt_B is real and B Hermitian, so this
+        # only needs Re B(j, j') of the upper triangle, one at a time.
+        beta = self.cal_betas(rs)
+        out = np.zeros(beta.shape[0:1] + beta.shape[3:] + (6,), dtype=np.float32)
+        G = np.real(self.Gaunt_B).astype(np.float32)
         for j in range(3):
-            for j_ in range(3):
-                Glm = self.Gaunt_633[:, e[j] + 1, e[j_] + 1]
-                mtx[:, :, z, :] = mtx[:, :, z, :] + np.einsum('s,xy->xys', Glm, self.cal_B_mtx(j, j_, r))
-        mtx[:, :, z, :] = mtx[:, :, z, :] * hz[z]
-
-    def compute_sh_det1(self, mtx, x, r, hx):
-        e = [1, -1, 0]
+            for j_ in range(j, 3):
+                w = G[:, j, j_] if j == j_ else G[:, j, j_] + G[:, j_, j]
+                reB = np.real(beta[:, 0, j] * beta[:, 0, j_].conjugate() + beta[:, 1, j] * beta[:, 1, j_].conjugate())
+                for k in np.nonzero(w)[0]:
+                    out[..., k] += w[k] * reB
+        return out
+
+    def cal_B_all(self, rs):
+        # All 3 x 3 B(j, j') from the 6 beta fields of each plane in rs. B is
+        # Hermitian in (j, j'), so only the upper triangle is multiplied.
+        beta = self.cal_betas(rs)
+        B = np.zeros((len(beta), 3, 3) + beta.shape[3:], dtype=beta.dtype)
         for j in range(3):
-            for j_ in range(3):
-                Glm = self.Gaunt_633[:, e[j] + 1, e[j_] + 1]
-                mtx[x, :, :, :] = mtx[x, :, :, :] + np.einsum('s,yz->yzs', Glm, self.cal_B_mtx(j, j_, r))
-        mtx[x, :, :, :] = mtx[x, :, :, :] * hx[x]
+            for j_ in range(j, 3):
+                B[:, j, j_] = beta[:, 0, j] * beta[:, 0, j_].conjugate() + beta[:, 1, j] * beta[:, 1, j_].conjugate()
+                if j_ != j:
+                    B[:, j_, j] = B[:, j, j_].conjugate()
+        return B
+
+    def cal_betas(self, rs):
+        # The 2 x 3 beta fields (complex64) of the evenly spaced planes rs,
+        # transformed together in place. Since Phi(r + dr) = Phi(r)Phi(dr),
+        # only the first plane and the step dr need a complex exponential;
+        # the rest are propagated.
+        phase = np.zeros((len(rs),) + self.pupil_nu.shape, dtype=np.complex64)
+        phase[0] = self.Phi(self.pupil_nu, rs[0], self.vm)
+        if len(rs) > 1:
+            step = self.Phi(self.pupil_nu, rs[1] - rs[0], self.vm).astype(np.complex64)
+            for k in range(1, len(rs)):
+                np.multiply(phase[k - 1], step, out=phase[k])
+        beta = self.pupil_Ag * phase[:, None, None]
+        del phase
+        return fourier.ifftn(beta, axes=(-2, -1), out=beta, workers=1)
 
     def cal_B_mtx(self, j, j_, r):
-        mtx = self.cal_beta_mtx(0, j, r) * self.cal_beta_mtx(0, j_, r).conjugate() + \
-              self.cal_beta_mtx(1, j, r) * self.cal_beta_mtx(1, j_, r).conjugate()
-        return mtx
+        return self.cal_B_all([r])[0, j, j_]
 
     def cal_beta_mtx(self, i, j, r):
-        g = self.list_g()[i][j]
-        if self.optical_axis == [0, 0, 1]:  # z-detection
-            vm = self.n / self.lamb
-            vc = self.na * 2 / self.lamb
-            dx = np.fft.rfftfreq(self.X, d=self.data.vox_dim[0])
-            dy = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])
-
-            mx, my = np.meshgrid(dx, dy)
-            mx, my = mx.T, my.T
-            nu = np.sqrt(mx ** 2 + my ** 2)
-            nu[nu >= vc / 2] = vm - np.finfo(np.float32).eps
-            nu_phi = np.arctan2(my, mx)
-            A_mat = self.A(nu, vm)
-            A_mat[nu >= vc / 2] = 0
-            g_mat = g(nu, nu_phi, vm)
-            Phi_mat = self.Phi(nu, r, vm)
-
-            temp = A_mat * g_mat * Phi_mat
-            xstart = slice(0, (self.X // 2) + 1)
-            xend = slice(None, -(self.X // 2), -1)
-            ystart = slice(0, (self.Y // 2) + 1)
-            yend = slice(None, -(self.Y // 2), -1)
-            mtx = np.zeros((self.X, self.Y), dtype=temp.dtype)
-            mtx[xstart, ystart] = temp
-            mtx[xend, ystart] = temp[1:-1, :]
-            mtx[xstart, yend] = temp[:, 1:-1]
-            mtx[xend, yend] = temp[1:-1, 1:-1]
-
-            return np.fft.ifftn(mtx, axes=(0, 1))
-
-        if self.optical_axis == [1, 0, 0]:  # x-detection
-            vm = self.n / self.lamb
-            vc = self.na * 2 / self.lamb
-
-            dy = np.fft.rfftfreq(self.Y, d=self.data.vox_dim[1])
-            dz = np.fft.rfftfreq(self.Z, d=self.data.vox_dim[2])
-
-            my, mz = np.meshgrid(dy, dz)
-            my, mz = my.T, mz.T
-            nu = np.sqrt(my ** 2 + mz ** 2)
-            nu[nu >= vc / 2] = vm - np.finfo(np.float32).eps
-            nu_phi = np.arctan2(mz, my)
-            A_mat = self.A(nu, vm)
-            A_mat[nu >= vc / 2] = 0
-            g_mat = g(nu, nu_phi, vm)
-            Phi_mat = self.Phi(nu, r, vm)
-
-            temp = A_mat * g_mat * Phi_mat
-            ystart = slice(0, (self.Y // 2) + 1)
-            yend = slice(None, -(self.Y // 2), -1)
-            zstart = slice(0, (self.Z // 2) + 1)
-            zend = slice(None, -(self.Z // 2), -1)
-            mtx = np.zeros((self.Y, self.Z), dtype=temp.dtype)
-            mtx[ystart, zstart] = temp
-            mtx[yend, zstart] = temp[1:-1, :]
-            mtx[ystart, zend] = temp[:, 1:-1]
-            mtx[yend, zend] = temp[1:-1, 1:-1]
-
-            return np.fft.ifftn(mtx, axes=(0, 1))
+        return self.cal_betas([r])[0, i, j]
 
     def list_g(self):
         def g00(nu, nu_phi, vm):
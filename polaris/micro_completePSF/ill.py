@@ -20,6 +20,8 @@ class Illuminator:
         self.optical_axis = optical_axis
 
     def calc_H(self):
+        # Reads the polarizers from data every time, see Data.set_pols
+        self.P = self.data.P
         sh_ills = []
         if self.optical_axis == [1, 0, 0]:
             sh_ills = np.zeros((self.P, 6))
@@ -24,20 +24,50 @@ class Microscope:
 
         self.Gaunt = np.load(os.path.join(os.path.dirname(__file__), '../harmonics/gaunt_l4.npy'))
 
-    def calc_H(self):
-        det_mtx = self.det.calc_H()
-        ill_mtx = self.ill.calc_H()
+    def calc_H(self, out=None, disk_cache=None, memo=None):
+        # If out is given (e.g. a memory-mapped array) H is written into it.
+        # The detection field comes from Detector.field, so with a memo only
+        # the cheap illumination and Gaunt contraction run when just the
+        # polarizers changed.
+        det_mtx = self.det.field(disk_cache=disk_cache, memo=memo)
+        support = self.det.support()
+        GI = np.reshape(self.calc_GI(), (6, -1))
 
-        H = np.zeros(det_mtx.shape[0:3] + (self.J, self.P,), dtype=np.complex64)
+        H = out
+        if H is None:
+            H = np.zeros(det_mtx.shape[0:3] + (self.J, self.P,), dtype=np.complex64)
         from joblib import Parallel, delayed
         Parallel(n_jobs=-1, backend='threading')(
-            tqdm([delayed(self.compute_view)(z, det_mtx, ill_mtx, H) for z in range(H.shape[2])]))
-        del det_mtx, ill_mtx
-        H = H / (np.max(np.abs(H)))
+            tqdm([delayed(self.compute_view)(z, det_mtx, GI, H, support) for z in range(H.shape[2])]))
+        del det_mtx, GI
+
+        # Normalize slab by slab
+        Hmax = max(np.max(np.abs(H[:, :, z])) for z in range(H.shape[2]))
+        for z in range(H.shape[2]):
+            H[:, :, z] /= Hmax
         return H
 
-    def compute_view(self, z, sh_det_mtx, sh_ills, H):
-        det = sh_det_mtx[:, :, z, :]
-        mat = np.einsum('jls,xys->xyjl', self.Gaunt[:, 0:6, 0:6], det)
-        mat = np.einsum('xyjl,pl->xyjp', mat, sh_ills)
-        H[:, :, z, :, :] = mat
+    def calc_GI(self):
+        # Gaunt tensor contracted with the illumination: 6 x J x P
+        ill_mtx = self.ill.calc_H()
+        self.P = ill_mtx.shape[0]
+        GI = np.einsum('jls,pl->sjp', self.Gaunt[:, 0:6, 0:6], ill_mtx)
+        return GI.astype(np.complex64)
+
+    def calc_H_factors(self, disk_cache=None, memo=None):
+        # The factors of calc_H without forming H: H = det GI, with det
+        # (X x Y x Z/2+1 x 6, zero outside the support) and GI (6 x J x P)
+        # normalized like calc_H
+        det_mtx = self.det.field(disk_cache=disk_cache, memo=memo) * self.det.support()[..., None]
+        GI = self.calc_GI()
+        GI2 = np.reshape(GI, (6, -1))
+        Hmax = max(np.max(np.abs(np.matmul(det_mtx[:, :, z], GI2))) for z in range(det_mtx.shape[2]))
+        return det_mtx, GI / Hmax
+
+    def compute_view(self, z, sh_det_mtx, GI, H, support):
+        # H is exactly zero outside the detection support
+        m = support[:, :, z]
+        det = sh_det_mtx[:, :, z, :][m].astype(np.complex64)
+        Hz = np.zeros(H.shape[0:2] + H.shape[3:], dtype=H.dtype)
+        Hz[m] = np.reshape(np.matmul(det, GI), (-1,) + H.shape[3:])
+        H[:, :, z, :, :] = Hz
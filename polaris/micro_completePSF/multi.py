@@ -1,5 +1,6 @@
 # Complete PSF
 from polaris.micro_completePSF import ill, det, micro
+from polaris import util, cache, noise, fourier
 import numpy as np
 from tqdm import tqdm
 import logging
@@ -9,7 +10,33 @@ log = logging.getLogger('log')
 
 
 class MultiMicroscope:
-    def __init__(self, spang, data, FWHM=2000, n_samp=1.33, lamb=525):
+    """A MultiMicroscope with the complete (non-paraxial) detection PSF.
+
+    If cache_dir is set, calc_H stores H there under a hash of everything
+    that determines it and reuses it for later identical microscopes.
+    cache_size limits the folder size in bytes.
+
+    H vanishes outside the detection support, so only its in-band entries
+    are stored, slab by slab (see util.BandedH). If H_file is set, they are
+    built directly in that memory-mapped .npy file and pinv, fwd and the
+    recon classes stream slabs from it, so H does not have to fit in memory.
+    Reopen it later with load_H(H_file, mmap_mode='r').
+
+    precompute_pinv stores the regularized pseudoinverse of every slab (in
+    memory or memory-mapped, also in-band only) so that repeated pinv calls with the same eta,
+    e.g. over a time-lapse, skip the per-frequency solves.
+
+    calc_H keeps each view's detection field in fields, so set_pols only
+    redoes the illumination. clear_field_cache() frees them; with H_file they
+    are not kept.
+
+    If lowrank_tol is set, H is instead stored as a util.LowRankH, a basis of
+    at most 6V matrices with per-frequency weights, truncated to that
+    relative error. It is exact with lowrank_tol=0 and about 10x smaller than
+    the dense H for 4 polarizers and 2 views.
+    """
+    def __init__(self, spang, data, FWHM=2000, n_samp=1.33, lamb=525,
+                 cache_dir=None, cache_size=None, H_file=None, lowrank_tol=None):
         self.spang = spang
         self.data = data
         self.X = spang.X
@@ -21,6 +48,13 @@ class MultiMicroscope:
         self.lamb = lamb
         self.FWHM = FWHM
         self.n_samp = n_samp
+        self.H_file = H_file
+        self.lowrank_tol = lowrank_tol
+        self.pinv_cache = None # (eta, solver, Pinv) from precompute_pinv
+        self.fields = None if H_file is not None else {} # Detection fields by key
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = cache.Cache(cache_dir, max_bytes=cache_size)
 
         m = []
         for i, det_optical_axis in enumerate(data.det_optical_axes):
@@ -35,69 +69,240 @@ class MultiMicroscope:
         self.Gaunt = np.load(os.path.join(os.path.dirname(__file__), '../harmonics/gaunt_l4.npy'))
 
     def calc_H(self):
+        if self.H_file is not None: # H_file persists H itself
+            self.compute_H()
+            return
+        if self.cache is not None:
+            key = self.H_key()
+            files = self.cache.load(key)
+            if files is not None:
+                self.set_H(self.H_from_files(files))
+                return
+        self.compute_H()
+        if self.cache is not None:
+            self.cache.save(key, **self.H_files())
+
+    def H_key(self):
+        # Everything that determines H
+        return cache.key({'model': 'completePSF',
+                          'shape': [self.X, self.Y, self.Z, self.J],
+                          'vox_dim': list(self.data.vox_dim),
+                          'det_nas': list(self.data.det_nas),
+                          'ill_optical_axes': self.data.ill_optical_axes,
+                          'det_optical_axes': self.data.det_optical_axes,
+                          'pols_norm': self.data.pols_norm,
+                          'lamb': self.lamb, 'n_samp': self.n_samp,
+                          'FWHM': self.FWHM,
+                          **({} if self.lowrank_tol is None else {'lowrank_tol': self.lowrank_tol})})
+
+    def H_files(self):
+        if isinstance(self.Hxyz, util.LowRankH):
+            return {'basis': self.Hxyz.basis, 'weights': self.Hxyz.weights}
+        return {'values': self.Hxyz.values}
+
+    def H_from_files(self, files):
+        if 'basis' in files:
+            return util.LowRankH(files['basis'], files['weights'])
+        if 'values' in files:
+            return util.BandedH(self.support(), files['values'])
+        return files['Hxyz']
+
+    def compute_H(self):
+        if self.lowrank_tol is not None:
+            self.set_H(self.compute_lowrank_H(self.lowrank_tol))
+            return
+
+        self.set_H(util.banded_array(self.support(), (15, self.P * self.V), np.complex64,
+                                     filename=self.H_file))
+
         log.info('Computing H for view 0')
-        self.H0 = self.micros[0].calc_H()
+        self.micros[0].calc_H(out=self.H0, disk_cache=self.cache, memo=self.fields)
 
         log.info('Computing H for view 1')
-        self.H1 = self.micros[1].calc_H()
+        self.micros[1].calc_H(out=self.H1, disk_cache=self.cache, memo=self.fields)
+        if isinstance(self.Hxyz.values, np.memmap):
+            self.Hxyz.values.flush()
+
+    def compute_lowrank_H(self, tol=0):
+        # View v is det_v (X x Y x Z/2+1 x 6) times a fixed 6 x J x P basis
+        # placed in its data channels, so H is exactly rank 6V before
+        # truncation and the dense H is never formed
+        weights = util.zslab_array((self.X, self.Y, self.Z // 2 + 1, 6 * self.V), np.complex64)
+        basis = np.zeros((6 * self.V, self.J, self.P * self.V), dtype=np.complex64)
+        for v, m in enumerate(self.micros):
+            log.info('Computing H for view ' + str(v))
+            det_mtx, GI = m.calc_H_factors(disk_cache=self.cache, memo=self.fields)
+            weights[..., 6 * v:6 * v + 6] = det_mtx
+            basis[6 * v:6 * v + 6, :, v::self.V] = GI
+            del det_mtx
+        return util.LowRankH(basis, weights).truncate(tol)
+
+    def set_pols(self, pols):
+        # Switch to new polarizers (V x P x 3, e.g. from util.pols_from_tilt)
+        # and recompute H. The detection fields are kept in fields (unless
+        # H_file is set), so this costs only the illumination and Gaunt
+        # contraction.
+        self.data.set_pols(pols)
+        self.P = self.data.P
+        self.calc_H()
+
+    def clear_field_cache(self):
+        if self.fields is not None:
+            self.fields.clear()
+
+    def support(self, v=None):
+        # Frequencies (X x Y x Z/2+1) where view v's H, or any view's H if v
+        # is None, can be nonzero
+        if v is not None:
+            return self.micros[v].det.support()
+        return np.any([m.det.support() for m in self.micros], axis=0)
 
-        self.Hxyz = np.stack([self.H0, self.H1], axis=-1)
-        self.Hxyz = np.reshape(self.Hxyz, self.H0.shape[0:3] + (15, self.P * self.V,))
+    def set_H(self, Hxyz):
+        self.Hxyz = Hxyz
+        self.pinv_cache = None
+        if isinstance(Hxyz, (util.LowRankH, util.BandedH)):
+            self.H0 = Hxyz.channels(slice(0, None, self.V))
+            self.H1 = Hxyz.channels(slice(1, None, self.V))
+            return
+        H = np.reshape(Hxyz, Hxyz.shape[0:4] + (self.P, self.V))
+        self.H0 = H[..., 0]
+        self.H1 = H[..., 1]
 
-    def pinv(self, g, eta):
+    def pinv(self, g, eta, solver='auto'):
         log.info('Applying pseudoinverse operator')
 
-        G = np.fft.rfftn(g, axes=(0, 1, 2))
+        G = fourier.rfftn(g, axes=(0, 1, 2))
         G2 = np.reshape(G, G.shape[0:3] + (self.P * self.V,))
 
         from joblib import Parallel, delayed
         F = np.zeros(self.Hxyz.shape[0:3] + (self.J,), dtype=np.complex64)
-        Parallel(n_jobs=-1, backend='threading')(
-            tqdm([delayed(self.compute_pinv)(F, G2, z, eta) for z in range(self.Hxyz.shape[2])]))
+        support = self.support()
+        if self.pinv_cache is not None and self.pinv_cache[0:2] == (eta, solver):
+            Pinv = self.pinv_cache[2]
+            Parallel(n_jobs=-1, backend='threading')(
+                tqdm([delayed(self.apply_pinv)(F, G2, z, Pinv, support) for z in range(F.shape[2])]))
+        else:
+            Parallel(n_jobs=-1, backend='threading')(
+                tqdm([delayed(self.compute_pinv)(F, G2, z, eta, solver, support) for z in range(F.shape[2])]))
 
         del G2, G
-        f = np.fft.irfftn(F, s=g.shape[0:3], axes=(0, 1, 2))
+        f = fourier.irfftn(F, s=g.shape[0:3], axes=(0, 1, 2))
         return np.real(f)
 
-    def compute_pinv(self, F, G2, z, eta):
-        u, s, vh = np.linalg.svd(self.Hxyz[:, :, z, :], full_matrices=False)
-        sreg = np.where(s > 1e-7, s / (s ** 2 + eta), 0)
-        Pinv = np.einsum('xysv,xyv,xyvd->xysd', u, sreg, vh)
-        F[:, :, z, :] = np.einsum('xysd,xyd->xys', Pinv, G2[:, :, z, :])
+    def compute_pinv(self, F, G2, z, eta, solver='auto', support=None):
+        # Only frequencies in the support are solved; F stays zero elsewhere
+        m = np.ones(F.shape[0:2], dtype=bool) if support is None else support[:, :, z]
+        Pinv = util.tikhonov_pinv(util.in_band(self.Hxyz, z, m), eta=eta, solver=solver)
+        F[:, :, z, :][m] = np.einsum('nsd,nd->ns', Pinv, G2[:, :, z, :][m])
+
+    def apply_pinv(self, F, G2, z, Pinv, support):
+        m = support[:, :, z]
+        F[:, :, z, :][m] = np.einsum('nsd,nd->ns', util.in_band(Pinv, z, m), G2[:, :, z, :][m])
+
+    def precompute_pinv(self, eta, solver='auto', filename=None):
+        # Regularized pseudoinverse (X x Y x Z/2+1 x J x PV) of every slab,
+        # stored in-band only (util.BandedH) in memory or in the
+        # memory-mapped .npy filename. pinv with the same eta and solver then
+        # only applies it.
+        log.info('Precomputing pseudoinverse')
+        support = self.support()
+        Pinv = util.banded_array(support, self.Hxyz.shape[3:], np.complex64, filename=filename)
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=-1, backend='threading')(
+            tqdm([delayed(self.compute_pinv_slab)(Pinv, z, eta, solver, support) for z in range(Pinv.shape[2])]))
+        if isinstance(Pinv.values, np.memmap):
+            Pinv.values.flush()
+        self.pinv_cache = (eta, solver, Pinv)
+
+    def compute_pinv_slab(self, Pinv, z, eta, solver, support):
+        m = support[:, :, z]
+        Pinv.band(z)[...] = util.tikhonov_pinv(util.in_band(self.Hxyz, z, m), eta=eta, solver=solver)
 
-    def fwd(self, f, snr=None):
+    def load_pinv(self, filename, eta, solver='auto', mmap_mode='r'):
+        # Reuse a precompute_pinv(eta, solver, filename=filename) result
+        values = np.load(filename, mmap_mode=mmap_mode)
+        Pinv = util.BandedH(self.support(), values)
+        if Pinv.shape != self.Hxyz.shape or len(values) != Pinv.offsets[-1]:
+            raise ValueError('Pseudoinverse in ' + filename + ' does not match H of shape ' +
+                             str(self.Hxyz.shape))
+        self.pinv_cache = (eta, solver, Pinv)
+
+    def fwd(self, f, snr=None, seed=None, noise_model=None, normalize=True):
         log.info('Applying forward operator')
 
         # 3D FT
-        F = np.fft.rfftn(f, axes=(0, 1, 2))
+        F = fourier.rfftn(f, axes=(0, 1, 2))
 
         # Tensor multiplication
         from joblib import Parallel, delayed
         G2 = np.zeros(self.Hxyz.shape[0:3] + (self.Hxyz.shape[4],), dtype=np.complex64)
+        support = self.support()
         Parallel(n_jobs=-1, backend='threading')(
-            tqdm([delayed(self.compute_fwd)(G2, F, z) for z in range(self.Hxyz.shape[2])]))
+            tqdm([delayed(self.compute_fwd)(G2, F, z, support) for z in range(self.Hxyz.shape[2])]))
         G = np.reshape(G2, G2.shape[0:3] + (self.P,) + (self.V,))
 
         # 3D IFT
-        g = np.real(np.fft.irfftn(G, s=f.shape[0:3], axes=(0, 1, 2)))
+        g = np.real(fourier.irfftn(G, s=f.shape[0:3], axes=(0, 1, 2)))
 
-        # Apply Poisson noise
-        if snr is not None:
-            norm = snr ** 2 / np.max(g)
-            g = g * norm
-            lam = (g.mean() / snr) ** 2
-            noise = np.random.poisson(lam=lam, size=g.shape) - lam
-            g = (g + noise) / norm
-            g = np.abs(g)
+        # Apply Poisson noise (or any noise.Noise camera model)
+        if noise_model is None and snr is not None:
+            noise_model = noise.Noise(snr=snr, seed=seed)
+        if noise_model is not None:
+            g = noise_model.realize(g, dtype=g.dtype)
 
+        if not normalize: # The linear map that adj is the adjoint of
+            return g
         g = g / np.max(g)
         return g
 
-    def compute_fwd(self, G2, F, z):
-        G2[:, :, z, :] = np.einsum('xysp,xys->xyp', self.Hxyz[:, :, z, :, :], F[:, :, z, :])
+    def compute_fwd(self, G2, F, z, support=None):
+        m = np.ones(G2.shape[0:2], dtype=bool) if support is None else support[:, :, z]
+        G2[:, :, z, :][m] = np.einsum('nsp,ns->np', util.in_band(self.Hxyz, z, m), F[:, :, z, :][m])
+
+    def adj(self, g):
+        # Adjoint of the (unnormalized, noise-free) forward operator: conj(H)
+        # applied slab by slab
+        G = fourier.rfftn(g, axes=(0, 1, 2))
+        G2 = np.reshape(G, G.shape[0:3] + (self.P * self.V,))
+        F = np.zeros(self.Hxyz.shape[0:3] + (self.J,), dtype=np.complex64)
+        support = self.support()
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=-1, backend='threading')(
+            [delayed(self.compute_adj)(F, G2, z, support) for z in range(F.shape[2])])
+        del G2, G
+        return fourier.irfftn(F, s=g.shape[0:3], axes=(0, 1, 2))
+
+    def compute_adj(self, F, G2, z, support):
+        m = support[:, :, z]
+        F[:, :, z, :][m] = np.einsum('nsp,np->ns', util.in_band(self.Hxyz, z, m).conjugate(), G2[:, :, z, :][m])
+
+    def as_linear_operator(self):
+        # fwd(normalize=False) and adj as a scipy LinearOperator on flattened
+        # spang (X*Y*Z*J) and data (X*Y*Z*P*V) arrays
+        return util.linear_operator(lambda f: self.fwd(f, normalize=False), self.adj,
+                                    (self.X, self.Y, self.Z, self.J),
+                                    (self.X, self.Y, self.Z, self.P, self.V))
 
-    def save_H(self, filename):
-        np.save(filename, self.Hxyz)
+    def save_H(self, filename, zslab=False):
+        # In-band entries are saved as they are; zslab only applies to dense H
+        if isinstance(self.Hxyz, util.LowRankH):
+            np.savez(filename, **self.H_files())
+        elif isinstance(self.Hxyz, util.BandedH):
+            np.save(filename, self.Hxyz.values)
+        elif zslab:
+            util.save_zslab(filename, self.Hxyz)
+        else:
+            np.save(filename, self.Hxyz)
 
-    def load_H(self, filename):
-        self.Hxyz = np.load(filename)
+    def load_H(self, filename, zslab=False, mmap_mode=None):
+        if filename.endswith('.npz'): # LowRankH from save_H
+            with np.load(filename) as files:
+                self.set_H(self.H_from_files(files))
+            return
+        H = np.load(filename, mmap_mode=mmap_mode)
+        if H.ndim == 3: # In-band entries, the mask is the support
+            self.set_H(util.BandedH(self.support(), H))
+        elif zslab:
+            self.set_H(np.moveaxis(H, 0, 2))
+        else:
+            self.set_H(H)
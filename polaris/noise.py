@@ -0,0 +1,52 @@
+import numpy as np
+import logging
+log = logging.getLogger('log')
+
+class Noise:
+    """A Noise object is a camera model for simulated data.
+
+    The brightest noise-free pixel collects snr**2 photons. Photon counts are
+    Poisson distributed, Gaussian read noise with standard deviation read_std
+    (in photons) is added, and the camera reports gain*(photons + read) +
+    offset. Realizations are returned in the units of the noise-free data, so
+    offset appears as a constant background.
+
+    Every realization i drawn by worker w uses its own numpy.random.Generator
+    seeded from (seed, w, i), so results are reproducible and independent
+    however the realizations are split across calls or workers.
+    """
+    def __init__(self, snr=None, read_std=0, gain=1, offset=0, seed=None):
+        self.snr = snr
+        self.read_std = read_std
+        self.gain = gain
+        self.offset = offset
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+
+    def rng(self, i=0, worker=0):
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(worker, i)))
+
+    def realize(self, g, n=None, start=0, worker=0, dtype=np.float32):
+        # One noisy realization of g, or n of them stacked along a new first
+        # axis. start offsets the realization index, e.g. to continue a run.
+        if n is None:
+            return self.draw(g, self.rng(start, worker), dtype)
+        out = np.zeros((n,) + g.shape, dtype=dtype)
+        for i in range(n):
+            out[i] = self.draw(g, self.rng(start + i, worker), dtype)
+        return out
+
+    def draw(self, g, rng, dtype=np.float32):
+        norm = 1.0
+        if self.snr is not None:
+            norm = self.snr**2/np.max(g)
+        photons = np.clip(g*norm, 0, None)
+        if self.snr is not None:
+            photons = rng.poisson(photons).astype(dtype)
+        else:
+            photons = photons.astype(dtype)
+        if self.read_std:
+            photons += rng.normal(0, self.read_std, size=g.shape).astype(dtype)
+        counts = self.gain*photons + self.offset
+        return (counts/(self.gain*norm)).astype(dtype)
@@ -3,24 +3,40 @@ from tqdm import tqdm
 import logging
 from joblib import Parallel, delayed
 from polaris.evaluation import eval
+from polaris import util, fourier
+from polaris.harmonics import gaunt
 import os
 
 log = logging.getLogger('log')
 
 
 class recon_single:
-    def __init__(self, multi):
+    def __init__(self, multi, stream=None):
         self.dispim = multi
         self.H = multi.Hxyz
+        self.support = multi.support()
 
         self.gaunt = multi.Gaunt * 3.5449077
+        self.sgaunt = gaunt.SparseGaunt(self.gaunt)
         self.s = multi.data.g.shape[0:3]
 
+        # Compute H_back and H_con slab by slab on demand instead of holding
+        # them in memory. Defaults to on when H is memory-mapped or compressed.
+        self.stream = util.is_streamed(self.H) if stream is None else stream
+        if not self.stream: # e.g. a util.BandedH held in memory
+            self.H = np.asarray(self.H)
+
         self.calc_H()
 
     def calc_H(self):
         log.info('Computing H_back and H_con')
 
+        if self.stream:
+            H = self.H
+            self.H_back = util.SlabArray(H.shape, H.dtype, lambda z: H[:, :, z].conjugate())
+            self.H_con = util.SlabArray(H.shape[0:3] + (15, 15,), H.dtype, lambda z: calc_H_con(H[:, :, z]))
+            return
+
         self.H_back = self.H.conjugate()
 
         self.H_con = np.zeros((self.H.shape[0:3]) + (15, 15,), dtype=np.complex64)
@@ -32,31 +48,33 @@ class recon_single:
     def compute_H_con(self, z):
         self.H_con[:, :, z, :, :] = np.einsum('xyjp,xysp->xyjs', self.H_back[:, :, z, :, :], self.H[:, :, z, :, :])
 
-    def ConvFFT3(self, Vol, OTF, order):
-        Vol_fft = np.fft.rfftn(Vol, axes=(0, 1, 2))
+    def ConvFFT3(self, Vol, OTF, order, support=None):
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2))
         temp = []
         if order == 0:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[4],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0, support) for z in range(temp.shape[2])])
         if order == 1:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1, support) for z in range(temp.shape[2])])
         if order == 2:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2) for z in range(temp.shape[2])])
-        Vol = np.real(np.fft.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2, support) for z in range(temp.shape[2])])
+        Vol = np.real(fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
         return Vol
 
-    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order):
+    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order, support=None):
+        # Frequencies outside the support of OTF are left at zero
+        m = np.ones(temp.shape[0:2], dtype=bool) if support is None else support[:, :, z]
         if order == 0:
-            temp[:, :, z, :] = np.einsum('xyj,xyjp->xyp', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('nj,njp->np', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 1:
-            temp[:, :, z, :] = np.einsum('xyp,xyjp->xyj', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('np,njp->nj', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 2:
-            temp[:, :, z, :] = np.einsum('xyjs,xys->xyj', OTF[:, :, z, :, :], inVol_fft[:, :, z, :])
+            temp[:, :, z, :][m] = np.einsum('njs,ns->nj', OTF[:, :, z, :, :][m], inVol_fft[:, :, z, :][m])
 
     def SHMul(self, SH0, SH1):
         outSH = SH0.copy() * 0
@@ -65,21 +83,22 @@ class recon_single:
         return outSH
 
     def compute_SHMul(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH0[:, :, z, :])
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat, SH1[:, :, z, :])
+        self.sgaunt.multiply(SH0[:, :, z, :], SH1[:, :, z, :], out=outSH[:, :, z, :])
 
-    def SHDiv(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+    def SHDiv(self, SH0, SH1, tol=1e-6):
+        # Voxels whose isotropic denominator is below tol times its maximum
+        # (empty regions) are set to zero
+        outSH = np.zeros_like(SH0)
+        mask = SH1[..., 0] > tol * np.max(SH1[..., 0])
         Parallel(n_jobs=-1, backend='threading')(
-            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
+            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z, mask) for z in range(SH0.shape[2])])
         return outSH
 
-    def compute_SHDiv(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH1[:, :, z, :])
-        mat_inv = np.linalg.inv(mat)
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat_inv, SH0[:, :, z, :])
+    def compute_SHDiv(self, outSH, SH0, SH1, z, mask=None):
+        self.sgaunt.divide(SH0[:, :, z, :], SH1[:, :, z, :], None if mask is None else mask[:, :, z],
+                           out=outSH[:, :, z, :])
 
-    def recon(self, g, iter_num=10):
+    def recon(self, g, iter_num=10, accelerate=False):
         log.info('Applying ISRA recon')
 
         img = (g - g.min()) / (g.max() - g.min())
@@ -87,27 +106,31 @@ class recon_single:
 
         ek = np.zeros(self.s + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
 
-        mid = self.ConvFFT3(img, self.H_back, order=1)
+        mid = self.ConvFFT3(img, self.H_back, order=1, support=self.support)
 
         for iter in tqdm(range(iter_num)):
-            bwd = self.ConvFFT3(ek, self.H_con, order=2)
+            acc.predict(ek)
+            bwd = self.ConvFFT3(ek, self.H_con, order=2, support=self.support)
             dif = self.SHDiv(mid, bwd)
             del bwd
             ek = self.SHMul(ek, dif)
             del dif
+            acc.step(ek)
 
         return ek
 
-    def recon_loss(self, g, iter_num, phant):
+    def recon_loss(self, g, iter_num, phant, accelerate=False):
 
         g = (g - g.min()) / (g.max() - g.min())
         img = g.reshape(self.s + (-1,))
 
         ek = np.zeros(self.s + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
 
-        mid = self.ConvFFT3(img, self.H_back, order=1)
+        mid = self.ConvFFT3(img, self.H_back, order=1, support=self.support)
 
         ssim_rcd = np.zeros(iter_num + 1)
         peak_rcd = np.zeros(iter_num + 1)
@@ -119,11 +142,13 @@ class recon_single:
         peak_rcd[0] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
 
         for iter in range(iter_num):
-            bwd = self.ConvFFT3(ek, self.H_con, order=2)
+            acc.predict(ek)
+            bwd = self.ConvFFT3(ek, self.H_con, order=2, support=self.support)
             dif = self.SHDiv(mid, bwd)
             del bwd
             ek = self.SHMul(ek, dif)
             del dif
+            acc.step(ek)
 
             ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
             peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
@@ -132,20 +157,37 @@ class recon_single:
 
 
 class recon_dual:
-    def __init__(self, multi):
+    def __init__(self, multi, stream=None):
         self.dispim = multi
 
         self.Ha = multi.H0
         self.Hb = multi.H1
+        self.support_a = multi.support(0)
+        self.support_b = multi.support(1)
 
         self.gaunt = multi.Gaunt * 3.5449077
+        self.sgaunt = gaunt.SparseGaunt(self.gaunt)
         self.s = multi.data.g.shape[0:3]
 
+        # Compute H_back and H_con slab by slab on demand instead of holding
+        # them in memory. Defaults to on when H is memory-mapped or compressed.
+        self.stream = util.is_streamed(self.Ha) if stream is None else stream
+        if not self.stream:
+            self.Ha, self.Hb = np.asarray(self.Ha), np.asarray(self.Hb)
+
         self.calc_H()
 
     def calc_H(self):
         log.info('Computing H_back and H_con')
 
+        if self.stream:
+            Ha, Hb = self.Ha, self.Hb
+            self.Ha_back = util.SlabArray(Ha.shape, Ha.dtype, lambda z: Ha[:, :, z].conjugate())
+            self.Hb_back = util.SlabArray(Hb.shape, Hb.dtype, lambda z: Hb[:, :, z].conjugate())
+            self.Ha_con = util.SlabArray(Ha.shape[0:3] + (15, 15,), Ha.dtype, lambda z: calc_H_con(Ha[:, :, z]))
+            self.Hb_con = util.SlabArray(Hb.shape[0:3] + (15, 15,), Hb.dtype, lambda z: calc_H_con(Hb[:, :, z]))
+            return
+
         self.Ha_back = self.Ha.conjugate()
         self.Hb_back = self.Hb.conjugate()
 
@@ -160,31 +202,33 @@ class recon_dual:
         self.Ha_con[:, :, z, :, :] = np.einsum('xyjp,xysp->xyjs', self.Ha_back[:, :, z, :, :], self.Ha[:, :, z, :, :])
         self.Hb_con[:, :, z, :, :] = np.einsum('xyjp,xysp->xyjs', self.Hb_back[:, :, z, :, :], self.Hb[:, :, z, :, :])
 
-    def ConvFFT3(self, Vol, OTF, order):
-        Vol_fft = np.fft.rfftn(Vol, axes=(0, 1, 2))
+    def ConvFFT3(self, Vol, OTF, order, support=None):
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2))
         temp = []
         if order == 0:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[4],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0, support) for z in range(temp.shape[2])])
         if order == 1:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1, support) for z in range(temp.shape[2])])
         if order == 2:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2) for z in range(temp.shape[2])])
-        Vol = np.real(np.fft.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2, support) for z in range(temp.shape[2])])
+        Vol = np.real(fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
         return Vol
 
-    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order):
+    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order, support=None):
+        # Frequencies outside the support of OTF are left at zero
+        m = np.ones(temp.shape[0:2], dtype=bool) if support is None else support[:, :, z]
         if order == 0:
-            temp[:, :, z, :] = np.einsum('xyj,xyjp->xyp', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('nj,njp->np', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 1:
-            temp[:, :, z, :] = np.einsum('xyp,xyjp->xyj', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('np,njp->nj', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 2:
-            temp[:, :, z, :] = np.einsum('xyjs,xys->xyj', OTF[:, :, z, :, :], inVol_fft[:, :, z, :])
+            temp[:, :, z, :][m] = np.einsum('njs,ns->nj', OTF[:, :, z, :, :][m], inVol_fft[:, :, z, :][m])
 
     def SHMul(self, SH0, SH1):
         outSH = SH0.copy() * 0
@@ -193,21 +237,22 @@ class recon_dual:
         return outSH
 
     def compute_SHMul(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH0[:, :, z, :])
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat, SH1[:, :, z, :])
+        self.sgaunt.multiply(SH0[:, :, z, :], SH1[:, :, z, :], out=outSH[:, :, z, :])
 
-    def SHDiv(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+    def SHDiv(self, SH0, SH1, tol=1e-6):
+        # Voxels whose isotropic denominator is below tol times its maximum
+        # (empty regions) are set to zero
+        outSH = np.zeros_like(SH0)
+        mask = SH1[..., 0] > tol * np.max(SH1[..., 0])
         Parallel(n_jobs=-1, backend='threading')(
-            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
+            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z, mask) for z in range(SH0.shape[2])])
         return outSH
 
-    def compute_SHDiv(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH1[:, :, z, :])
-        mat_inv = np.linalg.inv(mat)
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat_inv, SH0[:, :, z, :])
+    def compute_SHDiv(self, outSH, SH0, SH1, z, mask=None):
+        self.sgaunt.divide(SH0[:, :, z, :], SH1[:, :, z, :], None if mask is None else mask[:, :, z],
+                           out=outSH[:, :, z, :])
 
-    def recon(self, g, iter_num=10, mod=0):
+    def recon(self, g, iter_num=10, mod=0, accelerate=False):
         log.info('Applying ISRA recon')
 
         img = (g - g.min()) / (g.max() - g.min())
@@ -215,51 +260,57 @@ class recon_dual:
 
         ek = np.zeros(g.shape[0:3] + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
 
-        mid_a = self.ConvFFT3(imga, self.Ha_back, order=1)
-        mid_b = self.ConvFFT3(imgb, self.Hb_back, order=1)
+        mid_a = self.ConvFFT3(imga, self.Ha_back, order=1, support=self.support_a)
+        mid_b = self.ConvFFT3(imgb, self.Hb_back, order=1, support=self.support_b)
 
         if mod == 0:
             for iter in tqdm(range(iter_num)):
-                bwd = self.ConvFFT3(ek, self.Ha_con, order=2)
+                acc.predict(ek)
+                bwd = self.ConvFFT3(ek, self.Ha_con, order=2, support=self.support_a)
                 dif = self.SHDiv(mid_a, bwd)
                 del bwd
                 ek = self.SHMul(ek, dif)
                 del dif
 
-                bwd = self.ConvFFT3(ek, self.Hb_con, order=2)
+                bwd = self.ConvFFT3(ek, self.Hb_con, order=2, support=self.support_b)
                 dif = self.SHDiv(mid_b, bwd)
                 del bwd
                 ek = self.SHMul(ek, dif)
                 del dif
+                acc.step(ek)
 
         if mod == 1:
             for iter in tqdm(range(iter_num)):
-                bwd = self.ConvFFT3(ek, self.Ha_con, order=2)
+                acc.predict(ek)
+                bwd = self.ConvFFT3(ek, self.Ha_con, order=2, support=self.support_a)
                 dif = self.SHDiv(mid_a, bwd)
                 del bwd
                 ek_a = self.SHMul(ek, dif)
                 del dif
 
-                bwd = self.ConvFFT3(ek, self.Hb_con, order=2)
+                bwd = self.ConvFFT3(ek, self.Hb_con, order=2, support=self.support_b)
                 dif = self.SHDiv(mid_b, bwd)
                 del bwd
                 ek_b = self.SHMul(ek, dif)
                 del dif
 
                 ek = (ek_a + ek_b) / 2
+                acc.step(ek)
 
         return ek
 
-    def recon_loss(self, g, iter_num, phant, mod=0):
+    def recon_loss(self, g, iter_num, phant, mod=0, accelerate=False):
         g = (g - g.min()) / (g.max() - g.min())
         imga, imgb = g[..., 0], g[..., 1]
 
         ek = np.zeros(g.shape[0:3] + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
 
-        mid_a = self.ConvFFT3(imga, self.Ha_back, order=1)
-        mid_b = self.ConvFFT3(imgb, self.Hb_back, order=1)
+        mid_a = self.ConvFFT3(imga, self.Ha_back, order=1, support=self.support_a)
+        mid_b = self.ConvFFT3(imgb, self.Hb_back, order=1, support=self.support_b)
 
         ssim_rcd = np.zeros(iter_num + 1)
         peak_rcd = np.zeros(iter_num + 1)
@@ -272,38 +323,47 @@ class recon_dual:
 
         if mod == 0:
             for iter in tqdm(range(iter_num)):
-                bwd = self.ConvFFT3(ek, self.Ha_con, order=2)
+                acc.predict(ek)
+                bwd = self.ConvFFT3(ek, self.Ha_con, order=2, support=self.support_a)
                 dif = self.SHDiv(mid_a, bwd)
                 del bwd
                 ek = self.SHMul(ek, dif)
                 del dif
 
-                bwd = self.ConvFFT3(ek, self.Hb_con, order=2)
+                bwd = self.ConvFFT3(ek, self.Hb_con, order=2, support=self.support_b)
                 dif = self.SHDiv(mid_b, bwd)
                 del bwd
                 ek = self.SHMul(ek, dif)
                 del dif
+                acc.step(ek)
 
                 ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
                 peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
 
         if mod == 1:
             for iter in tqdm(range(iter_num)):
-                bwd = self.ConvFFT3(ek, self.Ha_con, order=2)
+                acc.predict(ek)
+                bwd = self.ConvFFT3(ek, self.Ha_con, order=2, support=self.support_a)
                 dif = self.SHDiv(mid_a, bwd)
                 del bwd
                 ek_a = self.SHMul(ek, dif)
                 del dif
 
-                bwd = self.ConvFFT3(ek, self.Hb_con, order=2)
+                bwd = self.ConvFFT3(ek, self.Hb_con, order=2, support=self.support_b)
                 dif = self.SHDiv(mid_b, bwd)
                 del bwd
                 ek_b = self.SHMul(ek, dif)
                 del dif
 
                 ek = (ek_a + ek_b) / 2
+                acc.step(ek)
 
                 ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
                 peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
 
         return ssim_rcd, peak_rcd
+
+
+def calc_H_con(H):
+    # H^H H for every frequency of a slab of H
+    return np.einsum('xyjp,xysp->xyjs', H.conjugate(), H)
@@ -3,77 +3,142 @@ from tqdm import tqdm
 import logging
 from joblib import Parallel, delayed
 from polaris.evaluation import eval
+from polaris import util, fourier
+from polaris.harmonics import gaunt
 import os
 
 log = logging.getLogger('log')
 
 
+class Workspace:
+    # Buffers for RL updates of a volume with shape s and estimates of dtype,
+    # allocated once and reused across iterations. FFTs run into them through
+    # the out arguments of polaris.fourier.
+    def __init__(self, s, J, P, dtype=np.float64):
+        sr = s[0:2] + (s[2] // 2 + 1,)
+        # Input spectra of the estimate and of the ratio
+        self.Fin = np.zeros(sr + (J,), dtype=fourier.spectrum_dtype(dtype))
+        self.Gin = np.zeros(sr + (P,), dtype=np.complex64)
+        # Product spectra
+        self.F = np.zeros(sr + (J,), dtype=np.complex64)
+        self.G = np.zeros(sr + (P,), dtype=np.complex64)
+        # Forward projection (then ratio) and back projection
+        self.g = np.zeros(s + (P,), dtype=np.float32)
+        self.f = np.zeros(s + (J,), dtype=np.float32)
+        # Spectra are only written inside the support they were last used with
+        self.support = None
+
+    def use(self, support):
+        if support is not self.support:
+            self.F.fill(0)
+            self.G.fill(0)
+            self.support = support
+
+
 class recon_single:
-    def __init__(self, multi):
+    def __init__(self, multi, stream=None):
         self.dispim = multi
         self.H = multi.Hxyz
+        self.support = multi.support()
 
         self.gaunt = multi.Gaunt * 3.5449077
+        self.sgaunt = gaunt.SparseGaunt(self.gaunt)
         self.s = multi.data.g.shape[0:3]
 
+        # Compute H_back slab by slab on demand instead of holding it in
+        # memory. Defaults to on when H is memory-mapped or compressed.
+        self.stream = util.is_streamed(self.H) if stream is None else stream
+        if not self.stream: # e.g. a util.BandedH held in memory
+            self.H = np.asarray(self.H)
+
         self.calc_H()
 
     def calc_H(self):
         log.info('Computing H_back')
 
-        self.H_back = self.H.conjugate()
-
         sv = self.H.sum(axis=(0, 1, 2, 4))
 
-        for p in range(self.H.shape[4]):
-            self.H_back[..., p] = self.SHDiv_1D(self.H_back[..., p], sv)
+        self.H_back = self.calc_H_back(self.H, sv)
+
+    def calc_H_back(self, H, sv):
+        if self.stream:
+            mat_inv = np.linalg.inv(np.einsum('jls,s->jl', self.gaunt, sv))
+            return util.SlabArray(H.shape, H.dtype, lambda z: np.einsum(
+                'jl,xylp->xyjp', mat_inv, H[:, :, z].conjugate()).astype(H.dtype))
+
+        H_back = H.conjugate()
+        for p in range(H.shape[4]):
+            H_back[..., p] = self.SHDiv_1D(H_back[..., p], sv)
+        return H_back
 
-    def ConvFFT3(self, Vol, OTF, order):
-        Vol_fft = np.fft.rfftn(Vol, axes=(0, 1, 2))
+    def ConvFFT3(self, Vol, OTF, order, support=None):
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2))
         temp = []
         if order == 0:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[4],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0, support) for z in range(temp.shape[2])])
         if order == 1:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1, support) for z in range(temp.shape[2])])
         if order == 2:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2) for z in range(temp.shape[2])])
-        Vol = np.real(np.fft.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2, support) for z in range(temp.shape[2])])
+        Vol = np.real(fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
         return Vol
 
-    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order):
+    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order, support=None):
+        # Frequencies outside the support of OTF are left at zero
+        m = np.ones(temp.shape[0:2], dtype=bool) if support is None else support[:, :, z]
         if order == 0:
-            temp[:, :, z, :] = np.einsum('xyj,xyjp->xyp', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('nj,njp->np', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 1:
-            temp[:, :, z, :] = np.einsum('xyp,xyjp->xyj', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('np,njp->nj', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 2:
-            temp[:, :, z, :] = np.einsum('xyjs,xys->xyj', OTF[:, :, z, :, :], inVol_fft[:, :, z, :])
+            temp[:, :, z, :][m] = np.einsum('njs,ns->nj', OTF[:, :, z, :, :][m], inVol_fft[:, :, z, :][m])
 
-    def SHMul(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+    def conv(self, Vol, OTF, order, support, spec, temp, out):
+        # ConvFFT3 (orders 0 and 1) through the preallocated input spectrum
+        # spec, product spectrum temp and output volume out
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2), out=spec)
+        Parallel(n_jobs=-1, backend='threading')(
+            [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, order, support) for z in range(temp.shape[2])])
+        return fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2), out=out)
+
+    def update(self, ek, img, H, H_back, support, ws, out=None):
+        # One RL step ek*H_back(img/max(H ek, 1e-10)) through the buffers of ws,
+        # written into ek unless out is given
+        ws.use(support)
+        fwd = self.conv(ek, H, 0, support, ws.Fin, ws.G, ws.g)
+        np.maximum(fwd, 1e-10, out=fwd)
+        np.divide(img, fwd, out=fwd)
+        bwd = self.conv(fwd, H_back, 1, support, ws.Gin, ws.F, ws.f)
+        return self.SHMul(ek, bwd, out=ek if out is None else out)
+
+    def SHMul(self, SH0, SH1, out=None):
+        outSH = np.zeros_like(SH0) if out is None else out
         Parallel(n_jobs=-1, backend='threading')(
             [delayed(self.compute_SHMul)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
         return outSH
 
     def compute_SHMul(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH0[:, :, z, :])
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat, SH1[:, :, z, :])
-
-    def SHDiv(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+        # outSH may be SH0: slab z is read in full before it is written
+        self.sgaunt.multiply(SH0[:, :, z, :], SH1[:, :, z, :], out=outSH[:, :, z, :])
+
+    def SHDiv(self, SH0, SH1, tol=1e-6):
+        # Voxels whose isotropic denominator is below tol times its maximum
+        # (empty regions) are set to zero
+        outSH = np.zeros_like(SH0)
+        mask = SH1[..., 0] > tol * np.max(SH1[..., 0])
         Parallel(n_jobs=-1, backend='threading')(
-            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
+            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z, mask) for z in range(SH0.shape[2])])
         return outSH
 
-    def compute_SHDiv(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH1[:, :, z, :])
-        mat_inv = np.linalg.inv(mat)
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat_inv, SH0[:, :, z, :])
+    def compute_SHDiv(self, outSH, SH0, SH1, z, mask=None):
+        self.sgaunt.divide(SH0[:, :, z, :], SH1[:, :, z, :], None if mask is None else mask[:, :, z],
+                           out=outSH[:, :, z, :])
 
     def SHDiv_1D(self, SH0, SH1):
         mat = np.einsum('jls,s->jl', self.gaunt, SH1)
@@ -81,7 +146,7 @@ class recon_single:
         outSH = np.einsum('jl,xyzl->xyzj', mat_inv, SH0)
         return outSH
 
-    def recon(self, g, iter_num=10):
+    def recon(self, g, iter_num=10, accelerate=False):
         log.info('Applying Richardson-Lucy recon')
 
         img = (g - g.min()) / (g.max() - g.min())
@@ -89,24 +154,24 @@ class recon_single:
 
         ek = np.zeros(self.s + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
+        ws = Workspace(self.s, ek.shape[3], img.shape[3], ek.dtype)
 
         for iter in tqdm(range(iter_num)):
-            fwd = self.ConvFFT3(ek, self.H, order=0)
-            fwd[fwd < 1e-10] = 1e-10
-            dif = img / fwd
-            del fwd
-            bwd = self.ConvFFT3(dif, self.H_back, order=1)
-            del dif
-            ek = self.SHMul(ek, bwd)
+            acc.predict(ek)
+            self.update(ek, img, self.H, self.H_back, self.support, ws)
+            acc.step(ek)
 
         return ek
 
-    def recon_loss(self, g, iter_num, phant):
+    def recon_loss(self, g, iter_num, phant, accelerate=False):
         img = (g - g.min()) / (g.max() - g.min())
         img = img.reshape(self.s + (-1,))
 
         ek = np.zeros(self.s + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
+        ws = Workspace(self.s, ek.shape[3], img.shape[3], ek.dtype)
 
         ssim_rcd = np.zeros(iter_num + 1)
         peak_rcd = np.zeros(iter_num + 1)
@@ -118,13 +183,9 @@ class recon_single:
         peak_rcd[0] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
 
         for iter in tqdm(range(iter_num)):
-            fwd = self.ConvFFT3(ek, self.H, order=0)
-            fwd[fwd < 1e-10] = 1e-10
-            dif = img / fwd
-            del fwd
-            bwd = self.ConvFFT3(dif, self.H_back, order=1)
-            del dif
-            ek = self.SHMul(ek, bwd)
+            acc.predict(ek)
+            self.update(ek, img, self.H, self.H_back, self.support, ws)
+            acc.step(ek)
 
             ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
             peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
@@ -133,76 +194,114 @@ class recon_single:
 
 
 class recon_dual:
-    def __init__(self, multi):
+    def __init__(self, multi, stream=None):
         self.dispim = multi
 
         self.Ha = multi.H0
         self.Hb = multi.H1
+        self.support_a = multi.support(0)
+        self.support_b = multi.support(1)
 
         self.gaunt = multi.Gaunt * 3.5449077
+        self.sgaunt = gaunt.SparseGaunt(self.gaunt)
         self.s = multi.data.g.shape[0:3]
 
+        # Compute H_back slab by slab on demand instead of holding it in
+        # memory. Defaults to on when H is memory-mapped or compressed.
+        self.stream = util.is_streamed(self.Ha) if stream is None else stream
+        if not self.stream:
+            self.Ha, self.Hb = np.asarray(self.Ha), np.asarray(self.Hb)
+
         self.calc_H()
 
     def calc_H(self):
         log.info('Computing H_back')
 
-        self.Ha_back = self.Ha.conjugate()
-        self.Hb_back = self.Hb.conjugate()
-
         sva = self.Ha.sum(axis=(0, 1, 2, 4))
         svb = self.Hb.sum(axis=(0, 1, 2, 4))
 
-        for p in range(self.Ha.shape[4]):
-            self.Ha_back[..., p] = self.SHDiv_1D(self.Ha_back[..., p], sva)
-            self.Hb_back[..., p] = self.SHDiv_1D(self.Hb_back[..., p], svb)
+        self.Ha_back = self.calc_H_back(self.Ha, sva)
+        self.Hb_back = self.calc_H_back(self.Hb, svb)
+
+    def calc_H_back(self, H, sv):
+        if self.stream:
+            mat_inv = np.linalg.inv(np.einsum('jls,s->jl', self.gaunt, sv))
+            return util.SlabArray(H.shape, H.dtype, lambda z: np.einsum(
+                'jl,xylp->xyjp', mat_inv, H[:, :, z].conjugate()).astype(H.dtype))
 
-    def ConvFFT3(self, Vol, OTF, order):
-        Vol_fft = np.fft.rfftn(Vol, axes=(0, 1, 2))
+        H_back = H.conjugate()
+        for p in range(H.shape[4]):
+            H_back[..., p] = self.SHDiv_1D(H_back[..., p], sv)
+        return H_back
+
+    def ConvFFT3(self, Vol, OTF, order, support=None):
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2))
         temp = []
         if order == 0:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[4],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 0, support) for z in range(temp.shape[2])])
         if order == 1:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1) for z in range(temp.shape[2])])
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 1, support) for z in range(temp.shape[2])])
         if order == 2:
             temp = np.zeros(OTF.shape[0:3] + (OTF.shape[3],), dtype=np.complex64)
             Parallel(n_jobs=-1, backend='threading')(
-                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2) for z in range(temp.shape[2])])
-        Vol = np.real(np.fft.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
+                [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, 2, support) for z in range(temp.shape[2])])
+        Vol = np.real(fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2)))
         return Vol
 
-    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order):
+    def compute_ConvFFT3(self, temp, inVol_fft, OTF, z, order, support=None):
+        # Frequencies outside the support of OTF are left at zero
+        m = np.ones(temp.shape[0:2], dtype=bool) if support is None else support[:, :, z]
         if order == 0:
-            temp[:, :, z, :] = np.einsum('xyj,xyjp->xyp', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('nj,njp->np', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 1:
-            temp[:, :, z, :] = np.einsum('xyp,xyjp->xyj', inVol_fft[:, :, z, :], OTF[:, :, z, :, :])
+            temp[:, :, z, :][m] = np.einsum('np,njp->nj', inVol_fft[:, :, z, :][m], OTF[:, :, z, :, :][m])
         if order == 2:
-            temp[:, :, z, :] = np.einsum('xyjs,xys->xyj', OTF[:, :, z, :, :], inVol_fft[:, :, z, :])
+            temp[:, :, z, :][m] = np.einsum('njs,ns->nj', OTF[:, :, z, :, :][m], inVol_fft[:, :, z, :][m])
 
-    def SHMul(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+    def conv(self, Vol, OTF, order, support, spec, temp, out):
+        # ConvFFT3 (orders 0 and 1) through the preallocated input spectrum
+        # spec, product spectrum temp and output volume out
+        Vol_fft = fourier.rfftn(Vol, axes=(0, 1, 2), out=spec)
+        Parallel(n_jobs=-1, backend='threading')(
+            [delayed(self.compute_ConvFFT3)(temp, Vol_fft, OTF, z, order, support) for z in range(temp.shape[2])])
+        return fourier.irfftn(temp, s=Vol.shape[0:3], axes=(0, 1, 2), out=out)
+
+    def update(self, ek, img, H, H_back, support, ws, out=None):
+        # One RL step ek*H_back(img/max(H ek, 1e-10)) through the buffers of ws,
+        # written into ek unless out is given
+        ws.use(support)
+        fwd = self.conv(ek, H, 0, support, ws.Fin, ws.G, ws.g)
+        np.maximum(fwd, 1e-10, out=fwd)
+        np.divide(img, fwd, out=fwd)
+        bwd = self.conv(fwd, H_back, 1, support, ws.Gin, ws.F, ws.f)
+        return self.SHMul(ek, bwd, out=ek if out is None else out)
+
+    def SHMul(self, SH0, SH1, out=None):
+        outSH = np.zeros_like(SH0) if out is None else out
         Parallel(n_jobs=-1, backend='threading')(
             [delayed(self.compute_SHMul)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
         return outSH
 
     def compute_SHMul(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH0[:, :, z, :])
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat, SH1[:, :, z, :])
-
-    def SHDiv(self, SH0, SH1):
-        outSH = SH0.copy() * 0
+        # outSH may be SH0: slab z is read in full before it is written
+        self.sgaunt.multiply(SH0[:, :, z, :], SH1[:, :, z, :], out=outSH[:, :, z, :])
+
+    def SHDiv(self, SH0, SH1, tol=1e-6):
+        # Voxels whose isotropic denominator is below tol times its maximum
+        # (empty regions) are set to zero
+        outSH = np.zeros_like(SH0)
+        mask = SH1[..., 0] > tol * np.max(SH1[..., 0])
         Parallel(n_jobs=-1, backend='threading')(
-            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z) for z in range(SH0.shape[2])])
+            [delayed(self.compute_SHDiv)(outSH, SH0, SH1, z, mask) for z in range(SH0.shape[2])])
         return outSH
 
-    def compute_SHDiv(self, outSH, SH0, SH1, z):
-        mat = np.einsum('jls,xys->xyjl', self.gaunt, SH1[:, :, z, :])
-        mat_inv = np.linalg.inv(mat)
-        outSH[:, :, z, :] = np.einsum('xyjl,xyl->xyj', mat_inv, SH0[:, :, z, :])
+    def compute_SHDiv(self, outSH, SH0, SH1, z, mask=None):
+        self.sgaunt.divide(SH0[:, :, z, :], SH1[:, :, z, :], None if mask is None else mask[:, :, z],
+                           out=outSH[:, :, z, :])
 
     def SHDiv_1D(self, SH0, SH1):
         mat = np.einsum('jls,s->jl', self.gaunt, SH1)
@@ -210,7 +309,7 @@ class recon_dual:
         outSH = np.einsum('jl,xyzl->xyzj', mat_inv, SH0)
         return outSH
 
-    def recon(self, g, iter_num=10, mod=0):
+    def recon(self, g, iter_num=10, mod=0, accelerate=False):
         log.info('Applying Richardson-Lucy recon')
 
         img = (g - g.min()) / (g.max() - g.min())
@@ -218,53 +317,42 @@ class recon_dual:
 
         ek = np.zeros(g.shape[0:3] + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
+        ws = Workspace(self.s, ek.shape[3], imga.shape[3], ek.dtype)
+        if mod == 1:
+            ek_a, ek_b = np.zeros_like(ek), np.zeros_like(ek)
 
         if mod == 0:
             for iter in tqdm(range(iter_num)):
-                fwd = self.ConvFFT3(ek, self.Ha, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imga / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Ha_back, order=1)
-                del dif
-                ek = self.SHMul(ek, bwd)
-
-                fwd = self.ConvFFT3(ek, self.Hb, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imgb / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Hb_back, order=1)
-                del dif
-                ek = self.SHMul(ek, bwd)
+                acc.predict(ek)
+                self.update(ek, imga, self.Ha, self.Ha_back, self.support_a, ws)
+
+                self.update(ek, imgb, self.Hb, self.Hb_back, self.support_b, ws)
+                acc.step(ek)
 
         if mod == 1:
             for iter in tqdm(range(iter_num)):
-                fwd = self.ConvFFT3(ek, self.Ha, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imga / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Ha_back, order=1)
-                del dif
-                ek_a = self.SHMul(ek, bwd)
-
-                fwd = self.ConvFFT3(ek, self.Hb, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imgb / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Hb_back, order=1)
-                del dif
-                ek_b = self.SHMul(ek, bwd)
-
-                ek = (ek_a + ek_b) / 2
+                acc.predict(ek)
+                self.update(ek, imga, self.Ha, self.Ha_back, self.support_a, ws, out=ek_a)
+
+                self.update(ek, imgb, self.Hb, self.Hb_back, self.support_b, ws, out=ek_b)
+
+                np.add(ek_a, ek_b, out=ek)
+                ek *= 0.5
+                acc.step(ek)
 
         return ek
 
-    def recon_loss(self, g, iter_num, phant, mod=0):
+    def recon_loss(self, g, iter_num, phant, mod=0, accelerate=False):
         img = (g - g.min()) / (g.max() - g.min())
         imga, imgb = img[..., 0], img[..., 1]
 
         ek = np.zeros(g.shape[0:3] + (15,))
         ek[..., 0] = 1
+        acc = util.Extrapolation(accelerate)
+        ws = Workspace(self.s, ek.shape[3], imga.shape[3], ek.dtype)
+        if mod == 1:
+            ek_a, ek_b = np.zeros_like(ek), np.zeros_like(ek)
 
         ssim_rcd = np.zeros(iter_num + 1)
         peak_rcd = np.zeros(iter_num + 1)
@@ -277,44 +365,25 @@ class recon_dual:
 
         if mod == 0:
             for iter in tqdm(range(iter_num)):
-                fwd = self.ConvFFT3(ek, self.Ha, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imga / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Ha_back, order=1)
-                del dif
-                ek = self.SHMul(ek, bwd)
-
-                fwd = self.ConvFFT3(ek, self.Hb, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imgb / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Hb_back, order=1)
-                del dif
-                ek = self.SHMul(ek, bwd)
+                acc.predict(ek)
+                self.update(ek, imga, self.Ha, self.Ha_back, self.support_a, ws)
+
+                self.update(ek, imgb, self.Hb, self.Hb_back, self.support_b, ws)
+                acc.step(ek)
 
                 ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
                 peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
 
         if mod == 1:
             for iter in tqdm(range(iter_num)):
-                fwd = self.ConvFFT3(ek, self.Ha, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imga / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Ha_back, order=1)
-                del dif
-                ek_a = self.SHMul(ek, bwd)
-
-                fwd = self.ConvFFT3(ek, self.Hb, order=0)
-                fwd[fwd < 1e-10] = 1e-10
-                dif = imgb / fwd
-                del fwd
-                bwd = self.ConvFFT3(dif, self.Hb_back, order=1)
-                del dif
-                ek_b = self.SHMul(ek, bwd)
-
-                ek = (ek_a + ek_b) / 2
+                acc.predict(ek)
+                self.update(ek, imga, self.Ha, self.Ha_back, self.support_a, ws, out=ek_a)
+
+                self.update(ek, imgb, self.Hb, self.Hb_back, self.support_b, ws, out=ek_b)
+
+                np.add(ek_a, ek_b, out=ek)
+                ek *= 0.5
+                acc.step(ek)
 
                 ssim_rcd[iter + 1] = eval.SSIM(ek[..., 0], phant.f[..., 0])
                 peak_rcd[iter + 1] = eval.PeakDif(ek, label_f, BinvT, Bvertices)
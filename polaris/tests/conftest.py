@@ -0,0 +1,18 @@
+from polaris import spang, data
+import numpy as np
+import pytest
+
+@pytest.fixture
+def make_complete_micro():
+    # Builds a complete-PSF MultiMicroscope with H computed
+    def make(px=(10,8,6), pols=None, **kw):
+        from polaris.micro_completePSF import multi as multi_c
+        kw_data = {} if pols is None else {'pols': pols}
+        P = 4 if pols is None else pols.shape[1]
+        data1 = data.Data(g=np.zeros(px + (P,2)), vox_dim=[130,130,130],
+                          det_nas=[1.1, 0.71], **kw_data)
+        spang1 = spang.Spang(f=np.zeros(px + (15,)), vox_dim=(130,130,130))
+        m = multi_c.MultiMicroscope(spang1, data1, n_samp=1.33, lamb=525, **kw)
+        m.calc_H()
+        return m
+    return make
@@ -0,0 +1,30 @@
+from polaris.micro import det
+import numpy as np
+
+def test_H_grid():
+    nu = np.linspace(0, 2.5, 7)
+    for axis in [[0,0,1], [1,0,0]]:
+        d = det.Detector(optical_axis=axis, na=1.1, n=1.33, sigma_ax=0.25)
+        grid = d.H_grid(nu[:,None,None], nu[None,:,None], nu[None,None,:])
+        for (x, y, z), nux in np.ndenumerate(grid[...,0]):
+            point = d.H(nu[x], nu[y], nu[z]).coeffs
+            assert np.allclose(grid[x,y,z], point[:6])
+            assert np.allclose(point[6:], 0)
+
+def test_H_grid_lut():
+    nu = np.linspace(0, 2.5, 101)
+    for axis in [[0,0,1], [1,0,0]]:
+        exact = det.Detector(optical_axis=axis, na=1.1, n=1.33)
+        lut = det.Detector(optical_axis=axis, na=1.1, n=1.33, lut_samples=2**14)
+        assert np.allclose(lut.H_grid(nu, nu[::-1], 0.3), exact.H_grid(nu, nu[::-1], 0.3), atol=1e-5)
+
+def test_complete_psf_propagation():
+    from polaris import spang, data
+    from polaris.micro_completePSF import det as cdet
+    px = (10,9,16)
+    data1 = data.Data(g=np.zeros(px + (4,2)), vox_dim=[130,130,130])
+    spang1 = spang.Spang(f=np.zeros(px + (15,)), vox_dim=(130,130,130))
+    for axis in [[0,0,1], [1,0,0]]:
+        d = cdet.Detector(spang1, data1, optical_axis=axis, na=1.1)
+        direct = d.calc_H(block=1)
+        assert np.allclose(d.calc_H(block=8), direct, rtol=0, atol=1e-6*np.abs(direct).max())
@@ -0,0 +1,66 @@
+from polaris import fourier
+import numpy as np
+import pytest
+
+@pytest.mark.parametrize('backend', fourier.BACKENDS)
+def test_backends(backend):
+    if backend == 'pyfftw':
+        pytest.importorskip('pyfftw')
+    a = np.random.random((6,5,7,3))
+    try:
+        fourier.set_backend(backend)
+        A = fourier.rfftn(a)
+        assert np.allclose(A, np.fft.rfftn(a, axes=(0,1,2)))
+        assert np.allclose(fourier.irfftn(A, s=a.shape[0:3]), a)
+        out = np.zeros((6,5,7,3), dtype=np.complex128)
+        fourier.fftn(a, axes=(0,1), out=out)
+        assert np.allclose(out, np.fft.fftn(a, axes=(0,1)))
+        if backend != 'numpy' or fourier._numpy_out():
+            # Written in place, not copied
+            out = np.zeros(A.shape, dtype=np.complex128)
+            assert np.shares_memory(fourier.rfftn(a, out=out), out)
+            real = np.zeros(a.shape)
+            assert np.shares_memory(fourier.irfftn(out, s=a.shape[0:3], out=real), real)
+            assert np.allclose(real, a)
+        fourier.set_backend(backend, single=True)
+        assert fourier.rfftn(a).dtype == np.complex64
+        assert fourier.irfftn(A, s=a.shape[0:3]).dtype == np.float32
+    finally:
+        fourier.set_backend()
+
+@pytest.mark.parametrize('backend', fourier.BACKENDS)
+def test_threads(backend):
+    # Transforms of the same shape from a thread pool must not share state
+    if backend == 'pyfftw':
+        pytest.importorskip('pyfftw')
+    from joblib import Parallel, delayed
+    a = np.random.random((16,8,6,5)) + 1j*np.random.random((16,8,6,5))
+    try:
+        fourier.set_backend(backend)
+        out = Parallel(n_jobs=4, backend='threading')(
+            [delayed(fourier.ifftn)(a[i], axes=(-2,-1), workers=1) for i in range(16)])
+        assert np.allclose(out, np.fft.ifftn(a, axes=(-2,-1)))
+    finally:
+        fourier.set_backend()
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        fourier.set_backend('fftpack')
+
+def test_pocketfft_out(monkeypatch):
+    # On the pinned scipy, out is filled by the private pocketfft kernels and
+    # not by a copy of the public scipy.fft result
+    import scipy.fft
+    assert fourier._pypocketfft() is not None
+    for name in ['rfftn', 'irfftn', 'fftn', 'ifftn']:
+        monkeypatch.setattr(scipy.fft, name, None)
+    a = np.random.random((6,5,7,3))
+    A = np.zeros((6,5,4,3), dtype=np.complex128)
+    fourier.rfftn(a, out=A)
+    assert np.allclose(A, np.fft.rfftn(a, axes=(0,1,2)))
+    real = np.zeros(a.shape)
+    fourier.irfftn(A, s=a.shape[0:3], out=real)
+    assert np.allclose(real, a)
+    A = A.astype(np.complex64)
+    fourier.ifftn(A.copy(), out=A)
+    assert np.allclose(A, np.fft.ifftn(np.fft.rfftn(a, axes=(0,1,2)), axes=(0,1,2)), atol=1e-5)
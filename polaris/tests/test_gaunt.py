@@ -0,0 +1,22 @@
+from polaris.harmonics import gaunt, shcoeffs
+import numpy as np
+
+def test_sparse_gaunt():
+    sg = gaunt.SparseGaunt(shcoeffs.G)
+    a = np.random.random((4,3,15))
+    b = np.random.random((4,3,15))
+    mat = np.einsum('jls,xys->xyjl', shcoeffs.G, a)
+    assert np.allclose(sg.matrix(a), mat)
+    assert np.allclose(sg.multiply(a, b), np.einsum('xyjl,xyl->xyj', mat, b))
+
+def test_sparse_gaunt_divide():
+    sg = gaunt.SparseGaunt(shcoeffs.G*np.sqrt(4*np.pi))
+    a = np.random.random((4,3,15))
+    b = np.zeros((4,3,15))
+    b[..., 0] = 1 + np.random.random((4,3))
+    b[..., 1:6] = 0.1*np.random.random((4,3,5))
+    b[0,0] = 0
+    x = sg.divide(a, b, mask=b[..., 0] > 0, block=5)
+    assert np.all(np.isfinite(x)) and np.all(x[0,0] == 0)
+    assert np.allclose(sg.multiply(x, b)[1:], a[1:])
+    assert np.all(np.isfinite(sg.divide(a, b)))
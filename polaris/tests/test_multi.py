@@ -0,0 +1,135 @@
+from polaris import spang, data
+from polaris.micro import multi
+import numpy as np
+
+def make_micro(px=(12,10,8)):
+    data1 = data.Data(g=np.zeros(px + (4,2)), vox_dim=[130,130,130],
+                      det_nas=[1.1, 0.71])
+    spang1 = spang.Spang(f=np.zeros(px + (15,)), vox_dim=(130,130,130))
+    m = multi.MultiMicroscope(spang1, data1, n_samp=1.33, lamb=525)
+    m.calc_H()
+    return m
+
+def test_adjoint():
+    for px in [(12,10,8), (9,11,7)]:
+        m = make_micro(px)
+        f = np.random.random(px + (15,))
+        g = np.random.random(px + (4,2))
+        F = np.fft.rfftn(f, axes=(0,1,2))
+        Af = np.fft.irfftn(m.apply_H(F), s=px, axes=(0,1,2))
+        assert np.isclose(np.sum(Af*g), np.sum(f*m.adj(g)), rtol=1e-5)
+
+def test_pinv_sweep(tmp_path):
+    m = make_micro()
+    g = np.random.random((12,10,8,4,2))
+    etas = [0, 1e-2, 1.04e-2, 1]
+    direct = [m.pinv(g, eta=eta) for eta in etas]
+    for (eta, f), f0 in zip(m.pinv_sweep(g, etas, folder=str(tmp_path)), direct):
+        assert np.allclose(f, f0, atol=1e-4*np.abs(f0).max())
+    assert len(list(tmp_path.iterdir())) == len(etas)
+    assert np.allclose(m.pinv(g, eta=1e-2, solver='gram'), direct[1], atol=1e-4*np.abs(direct[1]).max())
+
+def test_angular():
+    # Against the per-voxel einsum for every way of passing the mask
+    px = (6,5,4)
+    m = make_micro(px)
+    H = m.calc_angular_H()
+    u, s, vh = np.linalg.svd(np.reshape(H, (15, 8)), full_matrices=False)
+    M = np.einsum('lm,m,mn->ln', u, np.where(s > 1e-7, s/(s**2 + 1e-2), 0), vh)
+    f = np.random.random(px + (15,))
+    g = np.random.random(px + (4,2))
+    mask = np.random.random(px) > 0.5
+    g_ref = np.zeros(px + (4,2))
+    f_ref = np.zeros(px + (15,))
+    for x, y, z in zip(*np.nonzero(mask)):
+        g_ref[x,y,z] = np.einsum('spv,s->pv', H, f[x,y,z])
+        f_ref[x,y,z] = np.einsum('ln,n->l', M, np.ravel(g[x,y,z]))
+    g_ref /= np.max(g_ref)
+    for mk in [mask, np.nonzero(mask), np.flatnonzero(mask)]:
+        assert np.allclose(m.fwd_angular(f, mask=mk, chunk=7), g_ref)
+        assert np.allclose(m.pinv_angular(g, eta=1e-2, mask=mk, chunk=7), f_ref, atol=1e-6)
+
+def test_det_axes():
+    import pytest
+    px = (6,5,4)
+    for axis in [[0,1,0], [1,1,0], [0,0,-1]]:
+        data1 = data.Data(g=np.zeros(px + (4,2)), vox_dim=[130,130,130], det_nas=[1.1, 0.71],
+                          det_optical_axes=[[0,0,1], axis])
+        spang1 = spang.Spang(f=np.zeros(px + (15,)), vox_dim=(130,130,130))
+        with pytest.raises(ValueError, match='detection axis'):
+            multi.MultiMicroscope(spang1, data1)
+
+def test_projectors():
+    m = make_micro()
+    f = np.random.random((12,10,8,15))
+    p = m.pmeas(f)
+    assert np.allclose(m.pmeas(p), p, atol=1e-5)
+    assert np.allclose(p + m.pnull(f), f, atol=1e-5)
+
+def test_three_views():
+    px = (9,10,8)
+    pols = np.array([[[0,0,-1], [0,1,-1], [0,1,0], [0,1,1]],
+                     [[1,0,0], [1,1,0], [0,1,0], [-1,1,0]],
+                     [[0,0,-1], [0,1,-1], [0,1,0], [0,1,1]]])
+    data1 = data.Data(g=np.zeros(px + (4,3)), vox_dim=[130,130,130],
+                      ill_nas=3*[0], det_nas=[1.1, 0.71, 0.5],
+                      ill_optical_axes=[[1,0,0], [0,0,1], [1,0,0]],
+                      det_optical_axes=[[0,0,1], [1,0,0], [0,0,1]], pols=pols)
+    spang1 = spang.Spang(f=np.zeros(px + (15,)), vox_dim=(130,130,130))
+    m = multi.MultiMicroscope(spang1, data1, n_samp=1.33, lamb=525)
+    m.calc_H()
+    assert [view.axis for view in m.views] == [2, 0, 2]
+    f = np.random.random(px + (15,))
+    g = np.random.random(px + (4,3))
+    F = np.fft.rfftn(f, axes=(0,1,2))
+    Af = np.fft.irfftn(m.apply_H(F), s=px, axes=(0,1,2))
+    assert np.isclose(np.sum(Af*g), np.sum(f*m.adj(g)), rtol=1e-5)
+    assert m.pinv(Af, eta=1e-3).shape == px + (15,)
+
+def test_complete_psf_set_pols(make_complete_micro):
+    from polaris import util
+    px = (10,8,6)
+    pols = util.pols_from_tilt(np.arange(7), np.arange(7))
+    m = make_complete_micro(px, util.pols_from_tilt(np.arange(4), np.arange(4)))
+    m.set_pols(pols)
+    assert m.Hxyz.shape == px[0:2] + (px[2]//2 + 1, 15, 14)
+    assert m.Hxyz.nbytes < np.prod(m.Hxyz.shape)*8
+    assert np.allclose(m.Hxyz, make_complete_micro(px, pols).Hxyz)
+    assert len(m.fields) == 2
+    m.clear_field_cache()
+    assert not m.fields
+
+def test_complete_psf_lowrank(make_complete_micro):
+    px = (10,8,6)
+    dense = make_complete_micro(px)
+    lowrank = make_complete_micro(px, lowrank_tol=0)
+    assert lowrank.Hxyz.nbytes < dense.Hxyz.nbytes/5
+    assert np.allclose(lowrank.H1[:, :, 2], dense.H1[:, :, 2], atol=1e-6)
+    f = np.random.random(px + (15,))
+    assert np.allclose(lowrank.fwd(f), dense.fwd(f), atol=1e-5)
+
+def test_complete_psf_precompute_pinv(tmp_path, make_complete_micro):
+    px = (10,8,6)
+    m = make_complete_micro(px)
+    g = np.random.random(px + (4,2))
+    f = m.pinv(g, eta=1e-2)
+    m.precompute_pinv(1e-2, filename=str(tmp_path/'pinv.npy'))
+    assert np.allclose(m.pinv(g, eta=1e-2), f, atol=1e-6)
+    m.load_pinv(str(tmp_path/'pinv.npy'), 1e-2)
+    assert np.allclose(m.pinv(g, eta=1e-2), f, atol=1e-6)
+    m.precompute_pinv(1e-2, solver='svd')
+    m.pinv_cache[2].values[:] = 0 # Only used for the same eta and solver
+    assert np.allclose(m.pinv(g, eta=1e-2), f, atol=1e-6)
+    import pytest
+    with pytest.raises(ValueError, match='does not match'):
+        make_complete_micro((10,8,4)).load_pinv(str(tmp_path/'pinv.npy'), 1e-2)
+
+def test_linear_operator(make_complete_micro):
+    from scipy.sparse.linalg import lsqr
+    px = (10,8,6)
+    for m in [make_micro(px), make_complete_micro(px)]:
+        A = m.as_linear_operator()
+        f = np.random.random(A.shape[1])
+        g = np.random.random(A.shape[0])
+        assert np.isclose(np.dot(A.matvec(f), g), np.dot(f, A.rmatvec(g)), rtol=1e-5)
+        assert lsqr(A, A.matvec(f), damp=1e-3, iter_lim=5)[0].shape == f.shape
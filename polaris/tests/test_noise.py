@@ -0,0 +1,17 @@
+from polaris import noise
+import numpy as np
+
+def test_reproducible():
+    g = np.random.random((8, 8, 8, 4, 2))
+    n = noise.Noise(snr=10, read_std=2, offset=100, gain=2, seed=42)
+    batch = n.realize(g, n=3)
+    assert batch.shape == (3,) + g.shape
+    assert np.array_equal(batch[2], n.realize(g, start=2))
+    assert not np.array_equal(batch[0], batch[1])
+    assert not np.array_equal(batch[0], n.realize(g, worker=1))
+
+def test_poisson_mean():
+    g = np.full((100, 100), 0.5)
+    gs = noise.Noise(snr=10, seed=0).realize(g, n=10)
+    assert np.isclose(gs.mean(), 0.5, rtol=1e-2)
+    assert np.isclose(gs.var(), 0.5**2/100, rtol=5e-2)
@@ -0,0 +1,81 @@
+from polaris.recon import recon_RL
+import numpy as np
+
+def rl_step(r, ek, img, H, H_back, support):
+    # Reference RL step through the allocating ConvFFT3 and SHMul
+    fwd = r.ConvFFT3(ek, H, order=0, support=support)
+    fwd[fwd < 1e-10] = 1e-10
+    bwd = r.ConvFFT3(img / fwd, H_back, order=1, support=support)
+    return r.SHMul(ek, bwd)
+
+def test_rl_update(make_complete_micro):
+    r = recon_RL.recon_dual(make_complete_micro())
+    img = np.random.random(r.s + (4,2))
+    ek = np.zeros(r.s + (15,))
+    ek[..., 0] = 1
+    ek[..., 1:6] = 0.1*np.random.random(r.s + (5,))
+    ref = ek.copy()
+    ws = recon_RL.Workspace(r.s, 15, 4, ek.dtype)
+    for i in range(2):
+        # Alternating supports through one workspace
+        ref = rl_step(r, ref, img[..., 0], r.Ha, r.Ha_back, r.support_a)
+        r.update(ek, img[..., 0], r.Ha, r.Ha_back, r.support_a, ws)
+        ref = rl_step(r, ref, img[..., 1], r.Hb, r.Hb_back, r.support_b)
+        r.update(ek, img[..., 1], r.Hb, r.Hb_back, r.support_b, ws)
+    assert np.allclose(ek, ref, rtol=1e-4, atol=1e-6*np.abs(ref).max())
+
+def test_streamed(tmp_path, make_complete_micro):
+    # H built in H_file, or reloaded memory-mapped, is streamed slab by slab
+    from polaris import util
+    from polaris.recon import recon_ISRA
+    dense = make_complete_micro()
+    m = make_complete_micro(H_file=str(tmp_path/'H.npy'))
+    m.load_H(str(tmp_path/'H.npy'), zslab=True, mmap_mode='r')
+    util.save_zslab(str(tmp_path/'Hdense.npy'), np.asarray(dense.Hxyz))
+    m_dense = make_complete_micro()
+    m_dense.load_H(str(tmp_path/'Hdense.npy'), zslab=True, mmap_mode='r')
+    assert not util.is_streamed(dense.Hxyz)
+    f = np.zeros(dense.Hxyz.shape[0:2] + (6, 15))
+    f[3:7, 2:6, 2:5, 0] = 1
+    f[3:7, 2:6, 2:5, 3] = 0.3
+    g = dense.fwd(f)
+    for mm in [m, m_dense]:
+        assert util.is_streamed(mm.Hxyz)
+        assert np.allclose(np.asarray(mm.Hxyz), np.asarray(dense.Hxyz))
+        assert np.allclose(mm.fwd(f), g, atol=1e-6)
+        for recon in [recon_RL.recon_single, recon_RL.recon_dual,
+                      recon_ISRA.recon_single, recon_ISRA.recon_dual]:
+            r = recon(mm)
+            assert r.stream
+            ref = recon(dense).recon(g, iter_num=2)
+            assert np.allclose(r.recon(g, iter_num=2), ref, atol=1e-5*np.abs(ref).max())
+
+def test_accelerate_positive(make_complete_micro):
+    from polaris.recon import recon_ISRA
+    m = make_complete_micro((16,16,16))
+    f = np.zeros((16,16,16,15))
+    f[4:12, 5:11, 5:11, 0] = 1
+    f[4:12, 5:11, 5:11, 3] = 0.3
+    f[8:10, 2:14, 7:9, 0] = 2
+    f[8:10, 2:14, 7:9, 5] = -0.5
+    g = m.fwd(f)
+    for r, kw in [(recon_RL.recon_single(m), {}), (recon_ISRA.recon_dual(m), {'mod': 1})]:
+        ek = r.recon(g, iter_num=30, accelerate=True, **kw)
+        assert ek[..., 0].min() > 0
+
+def test_accelerate_empty(make_complete_micro):
+    # Voxels SHDiv zeroes as empty stay zero when accelerated
+    import functools
+    from polaris.recon import recon_ISRA
+    m = make_complete_micro((16,16,16))
+    f = np.zeros((16,16,16,15))
+    f[2:6, 2:6, 2:6, 0] = 1
+    f[2:6, 2:6, 2:6, 3] = 0.3
+    g = m.fwd(f)
+    for recon, kw in [(recon_ISRA.recon_single, {}), (recon_ISRA.recon_dual, {'mod': 1})]:
+        r = recon(m)
+        r.SHDiv = functools.partial(r.SHDiv, tol=0.1)
+        empty = r.recon(g, iter_num=20, **kw)[..., 0] == 0
+        ek = r.recon(g, iter_num=20, accelerate=True, **kw)
+        assert empty[9:14, 9:14, 9:14].all()
+        assert np.all(ek[empty] == 0)
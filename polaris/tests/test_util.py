@@ -0,0 +1,56 @@
+from polaris import util
+import numpy as np
+
+def test_tikhonov_pinv():
+    for shape in [(4, 15, 8), (4, 15, 42)]:
+        H = np.random.random(shape) + 1j*np.random.random(shape)
+        for eta in [0, 1e-2, 1]:
+            svd = util.tikhonov_pinv(H, eta=eta, solver='svd')
+            gram = util.tikhonov_pinv(H, eta=eta, solver='gram')
+            assert np.allclose(svd, gram)
+
+def test_cache(tmp_path):
+    from polaris import cache
+    c = cache.Cache(str(tmp_path), max_bytes=None)
+    k1 = cache.key({'shape': [4, 4], 'pols': np.eye(3)})
+    k2 = cache.key({'shape': [4, 5], 'pols': np.eye(3)})
+    assert k1 != k2 and c.load(k1) is None
+    c.save(k1, H=np.arange(10))
+    assert np.array_equal(c.load(k1)['H'], np.arange(10))
+    c.max_bytes = 1
+    c.save(k2, H=np.arange(10))
+    assert c.load(k1) is None and c.load(k2) is not None
+
+def test_even_fft():
+    for n in [1, 2, 7, 8]:
+        a = np.random.random((3, n//2 + 1, 2)).astype(np.float32)
+        full = a[:, util.rfftmirror(n)]
+        out = util.even_fft(a, n, axis=1)
+        assert out.dtype == np.float32
+        assert np.allclose(out, np.fft.rfft(full, axis=1).real, atol=1e-5)
+
+def test_banded():
+    mask = np.random.random((5,4,3)) > 0.3
+    dense = (np.random.random((5,4,3,2,6)) + 1j*np.random.random((5,4,3,2,6)))*mask[..., None, None]
+    H = util.banded_array(mask, (2,6), dense.dtype)
+    for z in range(3):
+        H[:, :, z] = dense[:, :, z]
+    assert H.nbytes < dense.nbytes
+    assert np.array_equal(np.asarray(H), dense)
+    assert np.array_equal(H[:, :, 1, 0], dense[:, :, 1, 0])
+    assert np.array_equal(util.in_band(H, 2, mask[:, :, 2]), dense[:, :, 2][mask[:, :, 2]])
+    assert np.array_equal(H.channels(slice(1, None, 2))[:, :, 0], dense[:, :, 0, :, 1::2])
+    assert np.allclose(H.conjugate().sum(axis=(0,1,2,4)), dense.conjugate().sum(axis=(0,1,2,4)))
+
+def test_extrapolation():
+    # A slowly converging fixed-point iteration converges faster when extrapolated
+    target = 1 + np.random.random((5,4,3,6))
+    def run(on):
+        x = np.ones(target.shape)
+        acc = util.Extrapolation(on)
+        for i in range(20):
+            acc.predict(x)
+            x = x + 0.1*(target - x)
+            acc.step(x)
+        return np.abs(x - target).max()
+    assert run(True) < run(False)/10
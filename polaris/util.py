@@ -154,6 +154,305 @@ def rfftlen(ind):
     else:
         return int((ind + 1)/2)
 
+# Index into an rfftfreq grid for every index of an fft grid of size n
+def rfftmirror(n):
+    k = np.arange(n)
+    return np.minimum(k, n - k)
+
+# Pairs of (fft grid slice, rfftfreq grid slice) covering the nonnegative and
+# negative frequencies of an fft grid of size n
+def rfftmirror_slices(n):
+    return [(slice(0, n//2 + 1), slice(0, n//2 + 1)),
+            (slice(n//2 + 1, n), slice(n - n//2 - 1, 0, -1))]
+
+# Fourier transform along axis of a real sequence of length n that is even
+# (a[n-k] = a[k]), given by its first n//2+1 samples. The transform is real
+# and even too, so only its first n//2+1 samples are returned, in the dtype of
+# a. Even n is a DCT-I; odd n uses the cosine matrix.
+def even_fft(a, n, axis=0):
+    if n % 2 == 0:
+        import scipy.fft
+        return scipy.fft.dct(a, type=1, axis=axis)
+    k = np.arange(n//2 + 1)
+    C = 2*np.cos(2*np.pi*np.outer(k, k)/n)
+    C[:,0] = 1
+    return np.moveaxis(np.tensordot(C.astype(a.dtype), a, axes=([1], [axis])), 0, axis)
+
+# Regularized pseudoinverse u s/(s**2 + eta) vh of a stack of system matrices
+# HH = u s vh (... x J x PV).
+#
+# solver='svd' takes a batched SVD of HH. solver='gram' solves the Tikhonov
+# system through the smaller of the J x J and PV x PV Gram matrices, which is
+# several times cheaper. solver='auto' uses 'gram' when eta > 0 and 'svd' for
+# the unregularized pseudoinverse, where squaring the condition number in the
+# Gram matrix would blur the rank cutoff.
+def tikhonov_pinv(HH, eta=0, solver='auto'):
+    if solver == 'auto':
+        solver = 'gram' if eta > 0 else 'svd'
+    if solver == 'svd':
+        u, s, vh = np.linalg.svd(HH, full_matrices=False)
+        sreg = np.where(s > 1e-7, s/(s**2 + eta), 0) # Regularize
+        return np.einsum('...sv,...v,...vd->...sd', u, sreg, vh, optimize=True)
+    if solver != 'gram':
+        raise ValueError('Unknown solver: ' + str(solver))
+
+    # Build the Gram matrix in double precision
+    H64 = HH.astype(np.result_type(HH.dtype, np.float64))
+    HHh = np.conj(np.swapaxes(H64, -1, -2))
+    J, PV = HH.shape[-2:]
+    left = J <= PV
+    K = np.matmul(H64, HHh) if left else np.matmul(HHh, H64)
+    if eta > 0:
+        K += eta*np.eye(K.shape[-1])
+        if left: # (HH HH^H + eta)^-1 HH
+            Pinv = np.linalg.solve(K, H64)
+        else: # HH (HH^H HH + eta)^-1 = ((HH^H HH + eta)^-1 HH^H)^H
+            Pinv = np.conj(np.swapaxes(np.linalg.solve(K, HHh), -1, -2))
+    else:
+        lam, W = np.linalg.eigh(K)
+        lreg = np.where(lam > 1e-14, 1/lam, 0)
+        Kinv = np.matmul(W*lreg[...,None,:], np.conj(np.swapaxes(W, -1, -2)))
+        Pinv = np.matmul(Kinv, H64) if left else np.matmul(H64, Kinv)
+    return Pinv.astype(HH.dtype)
+
+# Array of the given [x, y, z, ...] shape stored with z outermost, so [:, :, z]
+# slabs are contiguous. If filename is given the storage is a memory-mapped
+# .npy file and slabs are paged from disk as they are used.
+def zslab_array(shape, dtype, filename=None):
+    zshape = (shape[2],) + tuple(shape[0:2]) + tuple(shape[3:])
+    if filename is None:
+        a = np.zeros(zshape, dtype=dtype)
+    else:
+        a = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=zshape)
+    return np.moveaxis(a, 0, 2)
+
+# Read/write arrays in the z-outermost .npy layout of zslab_array
+def save_zslab(filename, a):
+    np.save(filename, np.moveaxis(a, 2, 0))
+
+def load_zslab(filename, mmap_mode=None):
+    return np.moveaxis(np.load(filename, mmap_mode=mmap_mode), 0, 2)
+
+# Array-like whose [:, :, z] slabs are computed on demand by func(z). Used to
+# stream transfer functions that are too large to hold in memory.
+class SlabArray:
+    def __init__(self, shape, dtype, func):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.func = func
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) < 3 or \
+           key[0] != slice(None) or key[1] != slice(None):
+            raise IndexError('SlabArray only supports [:, :, z, ...] indexing')
+        return self.func(key[2])[(slice(None), slice(None)) + key[3:]]
+
+# Matrix-free scipy LinearOperator on flattened arrays from a forward map of
+# f_shape arrays to g_shape arrays and its adjoint, e.g. for CG or LSQR
+def linear_operator(fwd, adj, f_shape, g_shape):
+    from scipy.sparse.linalg import LinearOperator
+    return LinearOperator((int(np.prod(g_shape)), int(np.prod(f_shape))), dtype=np.float64,
+                          matvec=lambda f: np.ravel(fwd(np.reshape(f, f_shape))).astype(np.float64),
+                          rmatvec=lambda g: np.ravel(adj(np.reshape(g, g_shape))).astype(np.float64))
+
+# Whether a transfer function should be used slab by slab rather than as a
+# whole: memory-mapped arrays, and array-likes such as SlabArray or LowRankH.
+# A BandedH held in memory is cheap to expand once and is not streamed.
+def is_streamed(H):
+    if isinstance(H, BandedH):
+        return isinstance(H.values, np.memmap)
+    return isinstance(H, np.memmap) or not isinstance(H, np.ndarray)
+
+# Compressed transfer function H[x, y, z] = sum_r weights[x, y, z, r] basis[r]
+# with a small basis (R x J x PV) shared by all frequencies. Like SlabArray it
+# stands in for the dense X x Y x Z/2+1 x J x PV array: [:, :, z, ...] slabs
+# are expanded on demand, and conjugate() and sum() work on the factors.
+class LowRankH:
+    def __init__(self, basis, weights):
+        self.basis = basis
+        self.weights = weights
+        self.shape = tuple(weights.shape[0:3]) + tuple(basis.shape[1:])
+        self.dtype = np.result_type(basis.dtype, weights.dtype)
+        self.ndim = len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.basis.nbytes + self.weights.nbytes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) < 3 or \
+           key[0] != slice(None) or key[1] != slice(None):
+            raise IndexError('LowRankH only supports [:, :, z, ...] indexing')
+        w = self.weights[:, :, key[2]]
+        slab = np.tensordot(w, self.basis, axes=(-1, 0)).astype(self.dtype)
+        return slab[(slice(None),)*(w.ndim - 1) + key[3:]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:, :, :] if dtype is None else self[:, :, :].astype(dtype)
+
+    def conjugate(self):
+        return LowRankH(self.basis.conjugate(), self.weights.conjugate())
+
+    def channels(self, idx):
+        # The same H restricted to the data channels idx
+        return LowRankH(self.basis[..., idx], self.weights)
+
+    def sum(self, axis):
+        # Sums over all frequencies (axes 0, 1 and 2) and optionally J or PV
+        axis = tuple(axis)
+        if not {0, 1, 2} <= set(axis):
+            raise ValueError('LowRankH can only be summed over all of x, y and z')
+        out = np.tensordot(self.weights.sum(axis=(0, 1, 2)), self.basis, axes=(0, 0))
+        rest = tuple(a - 3 for a in axis if a > 2)
+        return out.sum(axis=rest) if rest else out
+
+    def truncate(self, tol):
+        # Smallest basis whose relative Frobenius error, summed over all
+        # frequencies, is at most tol. The basis is orthonormalized
+        # (basis = Rb^T Q^T) so the error is the energy of the dropped
+        # principal components of the weights.
+        R = self.basis.shape[0]
+        Q, Rb = np.linalg.qr(np.reshape(self.basis, (R, -1)).T.astype(np.complex128))
+        C = np.zeros((R, R), dtype=np.complex128)
+        for z in range(self.shape[2]):
+            W = np.reshape(self.weights[:, :, z], (-1, R)) @ Rb.T
+            C += np.conj(W.T) @ W
+        lam, U = np.linalg.eigh(C)
+        lam, U = np.clip(lam[::-1], 0, None), U[:, ::-1]
+        left = np.sum(lam) - np.cumsum(lam) # Energy dropped by keeping k + 1
+        left[-1] = 0
+        k = 1 + np.argmax(left <= tol**2*np.sum(lam))
+        M = (Rb.T @ U[:, :k]).astype(self.weights.dtype)
+        basis = np.reshape(np.conj(U[:, :k].T) @ Q.T, (k,) + self.basis.shape[1:])
+        weights = zslab_array(self.shape[0:3] + (k,), self.weights.dtype)
+        for z in range(self.shape[2]):
+            weights[:, :, z] = self.weights[:, :, z] @ M
+        return LowRankH(basis.astype(self.basis.dtype), weights)
+
+# Transfer function that vanishes outside a frequency mask (X x Y x Z/2+1),
+# stored as its in-band entries only: values (N x J x PV) holds the entries
+# where mask is set, slab after slab in z and in the order of H[:, :, z][m]
+# within a slab. Like SlabArray, [:, :, z, ...] slabs are expanded on demand;
+# band(z) gives the packed entries of slab z (a view that can be written).
+class BandedH:
+    def __init__(self, mask, values):
+        self.mask = mask
+        self.values = values
+        self.offsets = np.concatenate([[0], np.cumsum(np.sum(mask, axis=(0, 1)))])
+        self.shape = tuple(mask.shape) + tuple(values.shape[1:])
+        self.dtype = values.dtype
+        self.ndim = len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.mask.nbytes
+
+    def band(self, z):
+        return self.values[self.offsets[z]:self.offsets[z + 1]]
+
+    def slab(self, z):
+        slab = np.zeros(self.shape[0:2] + self.shape[3:], dtype=self.dtype)
+        slab[self.mask[:, :, z]] = self.band(z)
+        return slab
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) < 3 or \
+           key[0] != slice(None) or key[1] != slice(None):
+            raise IndexError('BandedH only supports [:, :, z, ...] indexing')
+        if isinstance(key[2], slice):
+            zs = range(*key[2].indices(self.shape[2]))
+            return np.stack([self.slab(z) for z in zs], axis=2)[(slice(None),)*3 + key[3:]]
+        return self.slab(key[2])[(slice(None),)*2 + key[3:]]
+
+    def __setitem__(self, key, value):
+        # Whole slabs only; entries outside the mask are dropped
+        if not isinstance(key, tuple) or len(key) < 3 or isinstance(key[2], slice) or \
+           any(k != slice(None) for k in key[0:2] + key[3:]):
+            raise IndexError('BandedH only supports [:, :, z] assignment')
+        self.band(key[2])[...] = np.asarray(value)[self.mask[:, :, key[2]]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:, :, :] if dtype is None else self[:, :, :].astype(dtype)
+
+    def conjugate(self):
+        return BandedH(self.mask, self.values.conjugate())
+
+    def channels(self, idx):
+        # The same H restricted to the data channels idx
+        return BandedH(self.mask, self.values[..., idx])
+
+    def sum(self, axis):
+        # Sums over all frequencies (axes 0, 1 and 2) and optionally J or PV
+        axis = tuple(axis)
+        if not {0, 1, 2} <= set(axis):
+            raise ValueError('BandedH can only be summed over all of x, y and z')
+        return self.values.sum(axis=(0,) + tuple(a - 2 for a in axis if a > 2))
+
+# BandedH of zeros with per-frequency shape (e.g. J x PV) inside mask. If
+# filename is given the values are a memory-mapped .npy file.
+def banded_array(mask, shape, dtype, filename=None):
+    vshape = (int(np.sum(mask)),) + tuple(shape)
+    if filename is None:
+        values = np.zeros(vshape, dtype=dtype)
+    else:
+        values = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=vshape)
+    return BandedH(mask, values)
+
+# H[:, :, z][m], read straight from the packed entries when H is a BandedH
+# over the same mask
+def in_band(H, z, m):
+    if isinstance(H, BandedH) and np.array_equal(m, H.mask[:, :, z]):
+        return H.band(z)
+    return H[:, :, z][m]
+
+# Biggs-Andrews vector extrapolation for multiplicative iterations
+# x <- psi(x) such as RL and ISRA. predict(x) moves the estimate x in place
+# along its last step, y = x + alpha (x - x_prev), and step(x) records
+# x = psi(y). alpha is the correlation of the last two changes psi(y) - y,
+# clipped to [0, alpha_max]. Voxels whose isotropic coefficient would not
+# stay positive are not moved, and voxels where psi(y) turns negative fall
+# back to the last iterate. Zeros that psi sets on purpose (e.g. empty
+# regions in recon_ISRA.SHDiv) are kept. With on=False both are no-ops.
+class Extrapolation:
+    def __init__(self, on=True, alpha_max=0.95):
+        self.on = on
+        self.alpha_max = alpha_max
+        self.alpha = 0
+        self.x_prev = None
+        self.y = None
+        self.g_prev = None
+
+    def predict(self, x):
+        if not self.on:
+            return x
+        if self.x_prev is None:
+            self.x_prev, self.y = x.copy(), x.copy()
+            return x
+        h = x - self.x_prev
+        np.copyto(self.x_prev, x)
+        if self.alpha > 0:
+            h *= self.alpha
+            h += x
+            keep = h[..., 0] > 0
+            x[keep] = h[keep]
+        del h
+        np.copyto(self.y, x)
+        return x
+
+    def step(self, x):
+        if not self.on:
+            return
+        bad = x[..., 0] < 0
+        x[bad] = self.x_prev[bad]
+        g = x - self.y
+        if self.g_prev is None:
+            self.g_prev = g
+            return
+        norm = np.vdot(self.g_prev, self.g_prev)
+        self.alpha = 0 if norm <= 0 else float(np.clip(np.vdot(g, self.g_prev)/norm, 0, self.alpha_max))
+        np.copyto(self.g_prev, g)
+
 # For handling min/max and window/level consistently
 class ScaleMap:
     def __init__(self, min=0, max=1, window=None, level=None):